@@ -0,0 +1,312 @@
+"""
+Script to measure the speed of the hot paths on the real data
+and to check that the faster implementations give the same results.
+Suite action runs the downloaders end to end against the local stand-in of tenhou.net
+"""
+import gzip
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+from optparse import OptionParser
+
+from compression import LogCompressor, load_dictionaries
+from database import logs_with_content, migrate_database
+from download_game_ids import DownloadGameId
+from log_events import DISCARD, decode_rounds
+from tenhou_stand_in import Corpus, StandInServer
+from validate import LogParser
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+current_directory = os.path.dirname(os.path.realpath(__file__))
+logs_directory = os.path.join(current_directory, "temp")
+db_folder = os.path.join(current_directory, "db")
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-y", "--year", type="string", default=str(datetime.now().year), help="Target year")
+    parser.add_option("-p", "--db_path", type="string")
+    parser.add_option("-a", "--action", type="string", default="parser", help="parser, scc, events or suite")
+    parser.add_option("-l", "--limit", type="int", default=1000, help="How many logs to use")
+    parser.add_option("-t", "--threads", type="int", default=3, help="Count of download threads for suite")
+    parser.add_option("--days", type="int", default=7, help="Count of synthetic scc files for suite")
+    parser.add_option("--games", type="int", default=100, help="Count of games in one synthetic scc file")
+    parser.add_option("--latency", type="float", default=0, help="Seconds before each stand-in response")
+    parser.add_option("--error_rate", type="float", default=0, help="Part of failed stand-in log requests")
+    parser.add_option("-v", action="store_true", dest="verbose", help="Show output of the suite runs")
+    opts, _ = parser.parse_args()
+
+    if opts.db_path:
+        db_file = opts.db_path
+    else:
+        db_file = os.path.join(db_folder, f"{opts.year}.db")
+
+    if opts.action == "parser":
+        benchmark_parser(db_file, opts.limit)
+    elif opts.action == "scc":
+        benchmark_scc(opts.year)
+    elif opts.action == "events":
+        if np is None:
+            print("numpy package is required: pip install numpy")
+            return
+        benchmark_events(db_file, opts.limit)
+    elif opts.action == "suite":
+        benchmark_suite(opts)
+    else:
+        print("Unknown action")
+
+
+def load_logs(db_file, limit):
+    migrate_database(db_file)
+    connection = sqlite3.connect(db_file)
+    with connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            f"SELECT log_id, log_content, content_codec FROM {logs_with_content(cursor)} "
+            "where is_processed = 1 and was_error = 0 LIMIT ?;",
+            [limit],
+        )
+        data = cursor.fetchall()
+        compressor = LogCompressor(load_dictionaries(cursor))
+        logs = [(log_id, compressor.decompress(codec, content)) for log_id, content, codec in data]
+
+    print(f"Loaded {len(logs)} logs")
+    return logs
+
+
+def benchmark_parser(db_file, limit):
+    """
+    Compare LogParser.split_log_to_game_rounds with the bytes tokenizer
+    """
+    logs = load_logs(db_file, limit)
+    if not logs:
+        print("There are no downloaded logs")
+        return
+
+    parser = LogParser()
+
+    start_time = time.perf_counter()
+    old_results = [parser.split_log_to_game_rounds(log_content.decode("utf-8")) for _, log_content in logs]
+    old_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    new_results = [parser.split_log_bytes_to_game_rounds(log_content) for _, log_content in logs]
+    new_time = time.perf_counter() - start_time
+
+    mismatches = 0
+    for (log_id, _), old_rounds, new_rounds in zip(logs, old_results, new_results):
+        decoded_rounds = [[tag.decode("utf-8") for tag in game_round] for game_round in new_rounds]
+        if decoded_rounds != old_rounds:
+            mismatches += 1
+            print(f"Different rounds for {log_id}")
+
+    print(f"split_log_to_game_rounds: {len(logs) / old_time:.1f} logs/sec")
+    print(f"split_log_bytes_to_game_rounds: {len(logs) / new_time:.1f} logs/sec")
+    print(f"Speed up: {old_time / new_time:.1f}x")
+    print(f"Mismatches: {mismatches}/{len(logs)}")
+
+
+def benchmark_events(db_file, limit):
+    """
+    Compare a scan over string tags with the same scan over typed events,
+    as an example it counts discards of each player
+    """
+    logs = load_logs(db_file, limit)
+    if not logs:
+        print("There are no downloaded logs")
+        return
+
+    parser = LogParser()
+    rounds = [parser.split_log_bytes_to_game_rounds(log_content) for _, log_content in logs]
+    tags = [tag.decode("utf-8") for game_rounds in rounds for game_round in game_rounds for tag in game_round]
+
+    start_time = time.perf_counter()
+    events = np.concatenate([decode_rounds(game_rounds)[0] for game_rounds in rounds])
+    decode_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    tags_discards = [0, 0, 0, 0]
+    for tag in tags:
+        tag = tag.strip()
+        if tag[1] in "DEFG" and tag[2].isdigit():
+            tags_discards["DEFG".index(tag[1])] += 1
+    tags_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    events_discards = np.bincount(events["player"][events["kind"] == DISCARD], minlength=4).tolist()
+    events_time = time.perf_counter() - start_time
+
+    tags_size = sum([sys.getsizeof(tag) for tag in tags]) + sys.getsizeof(tags)
+    print(f"Decoded {len(events)} events from {len(tags)} tags in {decode_time:.2f} seconds")
+    print(f"Memory: {tags_size / 2**20:.1f} MB for tags, {events.nbytes / 2**20:.1f} MB for events")
+    print(f"Scan over tags: {tags_time * 1000:.1f} ms, over events: {events_time * 1000:.1f} ms")
+    print(f"Speed up: {tags_time / events_time:.1f}x")
+    print(f"Same results: {tags_discards == events_discards}")
+
+
+def benchmark_suite(opts):
+    """
+    Run id download, content download, validation and yakuman ids download
+    against the local stand-in of tenhou.net with synthetic games.
+    Each step is a separate process, so peak memory is measured for each of them
+    """
+    year = int(opts.year)
+    server = StandInServer(Corpus(year, opts.days, opts.games), opts.latency, opts.error_rate)
+    server.start()
+    print(f"Stand-in server with {opts.days * opts.games} games on {server.url}")
+
+    work_folder = tempfile.mkdtemp(prefix="tenhou_benchmark_")
+    db_file = os.path.join(work_folder, "suite.db")
+    yakuman_db_file = os.path.join(work_folder, "yakuman.db")
+    env = dict(os.environ, TENHOU_URL=server.url)
+
+    steps = [
+        ("ids", ["main.py", "-a", "id", "-p", db_file], db_file, "SELECT COUNT(*) FROM logs;"),
+        (
+            "content",
+            ["main.py", "-a", "content", "-p", db_file, "-l", str(opts.limit), "-t", str(opts.threads)]
+            + ["-r", "0", "--retries", "1", "--strip"],
+            db_file,
+            "SELECT COUNT(*) FROM logs where is_processed = 1;",
+        ),
+        (
+            "validate",
+            ["validate.py", "-p", db_file, "-s"],
+            db_file,
+            "SELECT COUNT(*) FROM logs where is_processed = 1 and was_error = 0;",
+        ),
+        (
+            "yakuman",
+            ["download_yakuman_game_ids.py", "--from", f"{year}-01", "--to", f"{year}-12"]
+            + ["-p", yakuman_db_file, "-t", str(opts.threads), "-r", "0"],
+            yakuman_db_file,
+            "SELECT COUNT(*) FROM logs;",
+        ),
+    ]
+
+    results = []
+    try:
+        for name, arguments, step_db_file, query in steps:
+            requests = server.requests
+            exit_code, seconds, peak_memory = run_step(arguments, env, opts.verbose)
+
+            items = 0
+            if os.path.exists(step_db_file):
+                connection = sqlite3.connect(step_db_file)
+                items = connection.execute(query).fetchone()[0]
+                connection.close()
+
+            results.append((name, exit_code, items, server.requests - requests, seconds, peak_memory))
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_folder)
+
+    print("")
+    print("Step        Items  Requests  Seconds  Items/sec  Peak memory")
+    for name, exit_code, items, requests, seconds, peak_memory in results:
+        print(
+            f"{name:<8} {items:>8} {requests:>9} {seconds:>8.2f} {items / seconds:>10.1f} {peak_memory:>9.1f} MB"
+            + (exit_code and f"  failed with exit code {exit_code}" or "")
+        )
+
+
+def run_step(arguments, env, verbose):
+    """
+    :return: exit code, seconds and peak resident memory of the process in MB
+    """
+    start_time = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable] + arguments,
+        cwd=current_directory,
+        env=env,
+        stdout=not verbose and subprocess.DEVNULL or None,
+        stderr=not verbose and subprocess.DEVNULL or None,
+    )
+    # wait4 gives resource usage of this process only, Popen.wait doesn't give it at all
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - start_time
+
+    # ru_maxrss is in kilobytes on linux
+    return process.returncode, seconds, usage.ru_maxrss / 1024
+
+
+def benchmark_scc(year):
+    """
+    Compare the old line by line scc parser with DownloadGameId one
+    on the year archive from temp folder
+    """
+    downloader = DownloadGameId(logs_directory, None, year, False, True)
+    print(f"Reading temp/scraw{year}.zip")
+
+    start_time = time.perf_counter()
+    old_results = process_year_archive_line_by_line(os.path.join(logs_directory, f"scraw{year}.zip"), year)
+    old_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    new_results = list(downloader.process_year_archive(year))
+    new_time = time.perf_counter() - start_time
+
+    old_results = [
+        (x["log_id"], x["game_date"], x["is_tonpusen"] and 1 or 0, x["is_sanma"] and 1 or 0)
+        for x in old_results
+    ]
+
+    print(f"Line by line parser: {len(old_results) / old_time:.0f} games/sec")
+    print(f"DownloadGameId parser: {len(new_results) / new_time:.0f} games/sec")
+    print(f"Speed up: {old_time / new_time:.1f}x")
+    print(f"Same results: {sorted(old_results) == sorted(new_results)}")
+
+
+def process_year_archive_line_by_line(archive_path, year):
+    """
+    Previous version of the scc parser, it is kept here to compare results
+    """
+    results = []
+    with zipfile.ZipFile(archive_path) as zip_file:
+        for member in zip_file.namelist():
+            file_name = os.path.basename(member)
+            if "scc" not in file_name:
+                continue
+
+            with zip_file.open(member) as f:
+                if ".gz" in file_name:
+                    f = gzip.open(f, "r")
+
+                for line in f:
+                    line = str(line, "utf-8").strip()
+                    # sometimes there is empty lines in the file
+                    if not line:
+                        continue
+
+                    result = line.split("|")
+                    game_type = result[2].strip()
+                    log_id = result[3].split("log=")[1].split('"')[0]
+                    game_date = datetime.strptime(
+                        log_id.split("gm-")[0][0:8] + result[0].strip(), "%Y%m%d%H:%M"
+                    ).strftime("%Y-%m-%d %H:%M")
+
+                    results.append(
+                        {
+                            "log_id": log_id,
+                            "is_tonpusen": game_type[2] == "東",
+                            "is_sanma": game_type.startswith("三"),
+                            "game_date": game_date,
+                        }
+                    )
+
+    return [x for x in results if x["game_date"][:4] == str(year)]
+
+
+if __name__ == "__main__":
+    main()
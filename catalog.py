@@ -0,0 +1,274 @@
+"""
+Catalog of the logs from all dbs: year dbs, yakuman dbs and others.
+It is one small db with metadata of each log and the db where it is stored,
+so we can find a game, scan several years with one query
+and don't download content of the log that was already downloaded to another db.
+
+The catalog is not updated by the downloaders, run sync after them:
+python catalog.py -a sync
+"""
+import glob
+import os
+import sqlite3
+from optparse import OptionParser
+
+from database import migrate_database
+from log_store import LogStore
+
+db_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "db")
+
+
+class Catalog(object):
+    def __init__(self, catalog_file):
+        self.catalog_file = catalog_file
+        # log stores of the shards opened by get_log
+        self.stores = {}
+
+        connection = sqlite3.connect(catalog_file)
+        with connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS shards(
+                    id integer primary key,
+                    path text unique,
+                    logs_count int
+                );
+                """
+            )
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS catalog(
+                    log_id text,
+                    shard_id int,
+                    date text,
+                    is_tonpusen int,
+                    is_sanma int,
+                    is_processed int,
+                    was_error int,
+                    primary key (log_id, shard_id)
+                );
+                """
+            )
+            cursor.execute("CREATE INDEX IF NOT EXISTS catalog_date ON catalog(date, log_id);")
+        connection.close()
+
+    def sync(self, db_files):
+        """
+        Replace catalog rows of each db with the current state of its logs table
+        """
+        connection = sqlite3.connect(self.catalog_file)
+
+        for db_file in db_files:
+            path = os.path.realpath(db_file)
+            if path == os.path.realpath(self.catalog_file):
+                continue
+
+            migrate_database(db_file)
+            connection.execute("ATTACH DATABASE ? AS shard;", [path])
+            with connection:
+                cursor = connection.cursor()
+                cursor.execute("INSERT OR IGNORE INTO shards (path) VALUES (?);", [path])
+                cursor.execute("SELECT id FROM shards WHERE path = ?;", [path])
+                shard_id = cursor.fetchone()[0]
+
+                cursor.execute("DELETE FROM catalog WHERE shard_id = ?;", [shard_id])
+                cursor.execute(
+                    "INSERT INTO catalog (log_id, shard_id, date, is_tonpusen, is_sanma, is_processed, was_error) "
+                    "SELECT log_id, ?, date, is_tonpusen, is_sanma, is_processed, was_error FROM shard.logs;",
+                    [shard_id],
+                )
+                logs_count = cursor.rowcount
+                cursor.execute("UPDATE shards SET logs_count = ? WHERE id = ?;", [logs_count, shard_id])
+            connection.execute("DETACH DATABASE shard;")
+
+            print(f"{db_file}: {logs_count} logs")
+
+        connection.close()
+
+    def locate(self, log_id):
+        """
+        :return: list of (db_file, is_processed, was_error) for each db with this log
+        """
+        connection = sqlite3.connect(self.catalog_file)
+        with connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT path, is_processed, was_error FROM catalog JOIN shards ON shards.id = catalog.shard_id "
+                "WHERE log_id = ? ORDER BY path;",
+                [log_id],
+            )
+            results = cursor.fetchall()
+        connection.close()
+        return results
+
+    def find_downloaded(self, log_ids, exclude_db_file=None):
+        """
+        :param exclude_db_file: db that shouldn't be used as a source, usually the db we download to
+        :return: dict of log id to the db file with its downloaded content
+        """
+        exclude_path = exclude_db_file and os.path.realpath(exclude_db_file) or ""
+        connection = sqlite3.connect(self.catalog_file)
+
+        results = {}
+        with connection:
+            cursor = connection.cursor()
+            for i in range(0, len(log_ids), 500):
+                part = log_ids[i : i + 500]
+                cursor.execute(
+                    "SELECT log_id, path FROM catalog JOIN shards ON shards.id = catalog.shard_id "
+                    f"WHERE log_id IN ({', '.join(['?'] * len(part))}) "
+                    "and is_processed = 1 and was_error = 0 and path != ?;",
+                    part + [exclude_path],
+                )
+                results.update(cursor.fetchall())
+
+        connection.close()
+        return results
+
+    def iterate_logs(
+        self,
+        from_date=None,
+        to_date=None,
+        is_sanma=None,
+        is_tonpusen=None,
+        downloaded_only=True,
+        batch_size=1000,
+    ):
+        """
+        Iterate logs of all dbs in the order of their dates, each log id is returned once.
+        If the log is in several dbs, the db with downloaded content is preferred,
+        then the db that was synced first. The date is taken from the chosen db,
+        dbs can have different dates of the same log, e.g. yakuman lists and scc files
+        :return: generator of (log_id, date, db_file) tuples
+        """
+        conditions = ["(date, log_id) > (?, ?)"]
+        parameters = []
+        if to_date is not None:
+            conditions.append("date < ?")
+            parameters.append(to_date)
+        if is_sanma is not None:
+            conditions.append("is_sanma = ?")
+            parameters.append(is_sanma and 1 or 0)
+        if is_tonpusen is not None:
+            conditions.append("is_tonpusen = ?")
+            parameters.append(is_tonpusen and 1 or 0)
+        if downloaded_only:
+            conditions.append("is_processed = 1 and was_error = 0")
+
+        # the row is skipped if the same log has a better row in another db, it is found by the primary key
+        conditions.append(
+            """NOT EXISTS (
+                SELECT 1 FROM catalog other
+                WHERE other.log_id = catalog.log_id and other.shard_id != catalog.shard_id and (
+                    (other.is_processed = 1 and other.was_error = 0)
+                    > (catalog.is_processed = 1 and catalog.was_error = 0)
+                    or (other.is_processed = 1 and other.was_error = 0)
+                    = (catalog.is_processed = 1 and catalog.was_error = 0)
+                    and other.shard_id < catalog.shard_id
+                )
+            )"""
+        )
+
+        query = (
+            "SELECT log_id, date, path FROM catalog JOIN shards ON shards.id = catalog.shard_id "
+            f"WHERE {' and '.join(conditions)} "
+            "ORDER BY date, log_id LIMIT ?;"
+        )
+
+        connection = sqlite3.connect(self.catalog_file)
+        last_date = from_date or ""
+        last_log_id = ""
+        while True:
+            with connection:
+                cursor = connection.cursor()
+                cursor.execute(query, [last_date, last_log_id] + parameters + [batch_size])
+                batch = cursor.fetchall()
+
+            if not batch:
+                break
+
+            last_log_id, last_date = batch[-1][0], batch[-1][1]
+            yield from batch
+
+        connection.close()
+
+    def get_log(self, log_id, db_file=None):
+        """
+        :param db_file: db with the log from find_downloaded or iterate_logs, to not look for it again
+        :return: decompressed log content from any db or None if it wasn't downloaded
+        """
+        db_file = db_file or self.find_downloaded([log_id]).get(log_id)
+        if not db_file:
+            return None
+
+        if db_file not in self.stores:
+            self.stores[db_file] = LogStore(db_file)
+        return self.stores[db_file].get_log(log_id)
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+        self.stores = {}
+
+
+def find_db_files(folder):
+    """
+    :return: year dbs from the folder and yakuman dbs from its subfolders
+    """
+    return sorted(glob.glob(os.path.join(folder, "**", "*.db"), recursive=True))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-c", "--catalog", type="string", default=os.path.join(db_folder, "catalog.db"))
+    parser.add_option("-a", "--action", type="string", default="sync", help="sync, locate or stats")
+    parser.add_option("--db_folder", type="string", default=db_folder, help="Folder with dbs to sync")
+    parser.add_option("--log_id", type="string", help="Log id to locate")
+    opts, _ = parser.parse_args()
+
+    catalog = Catalog(opts.catalog)
+
+    if opts.action == "sync":
+        catalog.sync(find_db_files(opts.db_folder))
+    elif opts.action == "locate":
+        results = catalog.locate(opts.log_id)
+        if not results:
+            print("There is no such log in the catalog")
+        for db_file, is_processed, was_error in results:
+            status = is_processed and (was_error and "error" or "downloaded") or "not downloaded"
+            print(f"{db_file}: {status}")
+    elif opts.action == "stats":
+        print_stats(opts.catalog)
+    else:
+        print("Unknown action")
+
+
+def print_stats(catalog_file):
+    connection = sqlite3.connect(catalog_file)
+
+    with connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT path, logs_count FROM shards ORDER BY path;")
+        for path, logs_count in cursor.fetchall():
+            print(f"{path}: {logs_count} logs")
+
+        cursor.execute("SELECT COUNT(DISTINCT log_id) FROM catalog;")
+        total = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(DISTINCT log_id) FROM catalog where is_processed = 1 and was_error = 0;")
+        downloaded = cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT COUNT(*) FROM (SELECT log_id FROM catalog GROUP BY log_id HAVING COUNT(*) > 1);"
+        )
+        duplicates = cursor.fetchone()[0]
+
+    connection.close()
+
+    print("")
+    print("Unique logs: {}".format(total))
+    print("Downloaded: {}".format(downloaded))
+    print("In several dbs: {}".format(duplicates))
+
+
+if __name__ == "__main__":
+    main()
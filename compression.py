@@ -0,0 +1,243 @@
+"""
+Codecs for the stored logs.
+By default each log is compressed with gzip on its own. Optional zstd codec
+uses a dictionary trained on the logs from the db, so the repeated XML tags
+are not stored in each row again. The codec is stored in content_codec column of each row:
+0 is gzip, any other value is the id of zstd dictionary from compression_dictionaries table.
+
+Script can train a new dictionary and recompress already downloaded logs with it.
+It requires zstandard package: pip install zstandard
+"""
+import calendar
+import gzip
+import os
+import random
+import sqlite3
+import threading
+from datetime import datetime
+from optparse import OptionParser
+
+from database import has_content_table, logs_with_content, migrate_database
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+db_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "db")
+
+GZIP_CODEC = 0
+
+ZSTD_LEVEL = 12
+DEFAULT_DICTIONARY_SIZE = 112640
+
+
+class LogCompressor(object):
+    """
+    Compress logs with the chosen codec and decompress logs of any codec.
+    zstd objects can't be shared between threads, so each thread has its own
+    """
+
+    def __init__(self, dictionaries=None, codec=GZIP_CODEC):
+        """
+        :param dictionaries: dict of zstd dictionary id to dictionary data
+        :param codec: codec for the new logs
+        """
+        self.dictionaries = dictionaries or {}
+        self.codec = codec
+        self.local = threading.local()
+
+        # dictionaries alone don't need the package, gzip logs of the db can be read without it
+        if codec != GZIP_CODEC:
+            check_zstandard()
+
+    def compress(self, log_content):
+        """
+        :return: codec and compressed content
+        """
+        if self.codec == GZIP_CODEC:
+            return GZIP_CODEC, gzip.compress(log_content)
+
+        return self.codec, self._zstd_objects(self.codec)[0].compress(log_content)
+
+    def decompress(self, codec, compressed_content):
+        if not codec:
+            return gzip.decompress(compressed_content)
+
+        return self._zstd_objects(codec)[1].decompress(compressed_content)
+
+    def _zstd_objects(self, dictionary_id):
+        if not hasattr(self.local, "zstd_objects"):
+            self.local.zstd_objects = {}
+
+        if dictionary_id not in self.local.zstd_objects:
+            check_zstandard()
+            dictionary = zstandard.ZstdCompressionDict(self.dictionaries[dictionary_id])
+            self.local.zstd_objects[dictionary_id] = (
+                zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary),
+                zstandard.ZstdDecompressor(dict_data=dictionary),
+            )
+
+        return self.local.zstd_objects[dictionary_id]
+
+
+def check_zstandard():
+    if zstandard is None:
+        raise RuntimeError("zstd codec requires zstandard package: pip install zstandard")
+
+
+def load_dictionaries(cursor):
+    cursor.execute("SELECT id, dictionary FROM compression_dictionaries;")
+    return {dictionary_id: dictionary for dictionary_id, dictionary in cursor.fetchall()}
+
+
+def load_latest_dictionary_id(cursor):
+    cursor.execute("SELECT MAX(id) FROM compression_dictionaries;")
+    return cursor.fetchone()[0]
+
+
+def create_compressor(db_file, codec):
+    """
+    :param codec: gzip or zstd, zstd uses the latest trained dictionary
+    :return: compressor or None if there is no dictionary for zstd
+    """
+    connection = sqlite3.connect(db_file)
+    with connection:
+        cursor = connection.cursor()
+        dictionaries = load_dictionaries(cursor)
+        latest_dictionary_id = load_latest_dictionary_id(cursor)
+    connection.close()
+
+    if codec == "gzip":
+        return LogCompressor(dictionaries)
+
+    if not latest_dictionary_id:
+        print("There is no zstd dictionary, train it with: python compression.py -a train")
+        return None
+
+    return LogCompressor(dictionaries, latest_dictionary_id)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-y", "--year", type="string", default=str(datetime.now().year), help="Target year")
+    parser.add_option("-p", "--db_path", type="string")
+    parser.add_option("-a", "--action", type="string", default="train", help="train or recompress")
+    parser.add_option("-s", "--samples", type="int", default=2000, help="Count of logs to train dictionary")
+    parser.add_option("--dictionary_size", type="int", default=DEFAULT_DICTIONARY_SIZE, help="In bytes")
+    parser.add_option("-b", "--batch_size", type="int", default=1000, help="Count of logs in one batch")
+    opts, _ = parser.parse_args()
+
+    if zstandard is None:
+        print("zstandard package is required: pip install zstandard")
+        return
+
+    if opts.db_path:
+        db_file = opts.db_path
+    else:
+        db_file = os.path.join(db_folder, f"{opts.year}.db")
+
+    migrate_database(db_file)
+
+    if opts.action == "train":
+        train_dictionary(db_file, opts.samples, opts.dictionary_size)
+    elif opts.action == "recompress":
+        recompress_logs(db_file, opts.batch_size)
+    else:
+        print("Unknown action")
+
+
+def train_dictionary(db_file, samples_count, dictionary_size):
+    connection = sqlite3.connect(db_file)
+
+    with connection:
+        cursor = connection.cursor()
+        compressor = LogCompressor(load_dictionaries(cursor))
+
+        cursor.execute(
+            f"SELECT log_id, log_content, content_codec FROM {logs_with_content(cursor)} "
+            "where is_processed = 1 and was_error = 0;"
+        )
+        # we don't know count of logs in advance, so take random logs with reservoir sampling
+        sample = []
+        for index, row in enumerate(cursor):
+            if len(sample) < samples_count:
+                sample.append(row)
+            else:
+                position = random.randint(0, index)
+                if position < samples_count:
+                    sample[position] = row
+
+        if not sample:
+            print("There are no downloaded logs")
+            return
+
+        print(f"Training dictionary on {len(sample)} logs...")
+        samples = [compressor.decompress(codec, content) for _, content, codec in sample]
+        dictionary = zstandard.train_dictionary(dictionary_size, samples)
+
+        unix_time = calendar.timegm(datetime.utcnow().utctimetuple())
+        cursor.execute(
+            "INSERT INTO compression_dictionaries (dictionary, created_at) VALUES (?, ?);",
+            [dictionary.as_bytes(), unix_time],
+        )
+        dictionary_id = cursor.lastrowid
+
+    print(f"Dictionary {dictionary_id} was saved")
+    print("New logs will use it with: python main.py -a content --codec zstd")
+
+
+def recompress_logs(db_file, batch_size):
+    """
+    Recompress all logs that don't use the latest dictionary
+    """
+    connection = sqlite3.connect(db_file)
+    compressor = create_compressor(db_file, "zstd")
+    if not compressor:
+        return
+
+    size_before = 0
+    size_after = 0
+    recompressed_logs = 0
+    last_log_id = ""
+    while True:
+        with connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                f"SELECT log_id, log_content, content_codec FROM {logs_with_content(cursor)} "
+                "where is_processed = 1 and was_error = 0 and log_id > ? ORDER BY log_id LIMIT ?;",
+                [last_log_id, batch_size],
+            )
+            batch = cursor.fetchall()
+            if not batch:
+                break
+
+            last_log_id = batch[-1][0]
+
+            rows = []
+            for log_id, content, codec in batch:
+                if codec == compressor.codec:
+                    continue
+
+                new_codec, new_content = compressor.compress(compressor.decompress(codec, content))
+                size_before += len(content)
+                size_after += len(new_content)
+                rows.append([new_content, new_codec, log_id])
+
+            table = has_content_table(cursor) and "logs_content" or "logs"
+            cursor.executemany(
+                f"UPDATE {table} SET log_content = ?, content_codec = ? WHERE log_id = ?;", rows
+            )
+            recompressed_logs += len(rows)
+
+        print(f"Recompressed {recompressed_logs} logs")
+
+    if recompressed_logs:
+        print(
+            f"Size before: {size_before} bytes, after: {size_after} bytes ({size_before / size_after:.1f}x)"
+        )
+    print("Run VACUUM on the db to return the free space to the file system")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Schema migrations for the logs databases.
+The applied schema version is stored in PRAGMA user_version,
+so it is safe to call migrate_database on each run.
+
+There are two layouts of the logs storage. Old dbs keep compressed logs
+in logs.log_content column, new dbs keep them in the separate logs_content table,
+so the metadata scans don't read the big blobs. Functions below
+hide the difference for the scripts.
+"""
+import sqlite3
+
+
+def add_queue_indices(cursor):
+    """
+    Partial indices for the download queue and the status counts,
+    they contain only rows in the specific state and stay small
+    """
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS logs_not_processed ON logs(log_id) WHERE is_processed = 0 and was_error = 0;"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS logs_processed ON logs(log_id) WHERE is_processed = 1;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS logs_with_errors ON logs(log_id) WHERE was_error = 1;")
+
+
+def add_content_codec(cursor):
+    """
+    Codec of the stored log: 0 is gzip, other values are zstd dictionary ids
+    """
+    table = has_content_table(cursor) and "logs_content" or "logs"
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN content_codec int default 0;")
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS compression_dictionaries(
+            id integer primary key,
+            dictionary blob,
+            created_at int
+        );
+        """
+    )
+
+
+def add_date_index(cursor):
+    """
+    Index of the downloaded logs by date for the range reads of LogStore
+    """
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS logs_downloaded_by_date ON logs(date, log_id) "
+        "WHERE is_processed = 1 and was_error = 0;"
+    )
+
+
+def add_downloaded_files(cursor):
+    """
+    scc files from list.cgi that were already added to the db
+    and validators of the last list.cgi response, so the next sync downloads only new files
+    """
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS downloaded_files(
+            name text primary key,
+            size int,
+            checksum text,
+            logs_count int,
+            downloaded_at int
+        );
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS http_validators(
+            url text primary key,
+            etag text,
+            last_modified text
+        );
+        """
+    )
+
+
+def add_learned_rates(cursor):
+    """
+    Request rates found by adaptive rate control for each server, the next run starts from them
+    """
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS learned_rates(
+            host text primary key,
+            rate real,
+            updated_at int
+        );
+        """
+    )
+
+
+def add_work_leases(cursor):
+    """
+    Logs claimed by a running content download: process id and unix time when the claim expires.
+    Claims of killed processes expire and other processes download these logs
+    """
+    cursor.execute("ALTER TABLE logs ADD COLUMN claimed_by text;")
+    cursor.execute("ALTER TABLE logs ADD COLUMN lease_expires int;")
+    # only claimed logs are in it, so lease updates don't scan the whole table
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS logs_claimed ON logs(claimed_by) WHERE claimed_by IS NOT NULL;"
+    )
+
+
+# migration number N upgrades the db to the schema version N
+MIGRATIONS = [
+    add_queue_indices,
+    add_content_codec,
+    add_date_index,
+    add_downloaded_files,
+    add_learned_rates,
+    add_work_leases,
+]
+
+
+def migrate_database(db_file):
+    connection = sqlite3.connect(db_file)
+
+    with connection:
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA user_version;")
+        version = cursor.fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"Migrating database {db_file} to the version {number}...")
+        with connection:
+            cursor = connection.cursor()
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number};")
+
+    connection.close()
+
+
+def has_content_table(cursor):
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' and name = 'logs_content';")
+    return cursor.fetchone()[0] > 0
+
+
+def has_content_codec(cursor):
+    """
+    :return: False for dbs before add_content_codec migration, they have only gzip logs
+    """
+    table = has_content_table(cursor) and "logs_content" or "logs"
+    cursor.execute(f"SELECT COUNT(*) FROM pragma_table_info('{table}') WHERE name = 'content_codec';")
+    return cursor.fetchone()[0] > 0
+
+
+def logs_with_content(cursor):
+    """
+    :return: table expression for FROM with logs columns, log_content and content_codec columns
+    """
+    if has_content_table(cursor):
+        return "logs LEFT JOIN logs_content USING (log_id)"
+    return "logs"
+
+
+def store_log_contents(cursor, rows):
+    """
+    Mark logs as processed and store their content
+    :param rows: list of (log_id, was_error, compressed_content, content_codec)
+    """
+    if not has_content_table(cursor):
+        cursor.executemany(
+            "UPDATE logs SET is_processed = 1, was_error = ?, log_content = ?, content_codec = ? WHERE log_id = ?;",
+            [[was_error and 1 or 0, content, codec, log_id] for log_id, was_error, content, codec in rows],
+        )
+        return
+
+    cursor.executemany(
+        "UPDATE logs SET is_processed = 1, was_error = ? WHERE log_id = ?;",
+        [[was_error and 1 or 0, log_id] for log_id, was_error, _, _ in rows],
+    )
+    cursor.executemany(
+        "INSERT OR REPLACE INTO logs_content (log_id, log_content, content_codec) VALUES (?, ?, ?);",
+        [[log_id, content, codec] for log_id, was_error, content, codec in rows if not was_error],
+    )
+    cursor.executemany(
+        "DELETE FROM logs_content WHERE log_id = ?;",
+        [[log_id] for log_id, was_error, _, _ in rows if was_error],
+    )
+
+
+def add_logs_to_download_queue(cursor, condition, parameters=()):
+    """
+    Reset processed state and claims of logs and remove their content
+    :param condition: sql condition for logs table
+    """
+    if not has_content_table(cursor):
+        cursor.execute(
+            'UPDATE logs set is_processed = 0, was_error = 0, log_content="", claimed_by = NULL, '
+            f"lease_expires = NULL where {condition};",
+            parameters,
+        )
+        return
+
+    cursor.execute(
+        f"DELETE FROM logs_content WHERE log_id IN (SELECT log_id FROM logs where {condition});", parameters
+    )
+    cursor.execute(
+        f"UPDATE logs set is_processed = 0, was_error = 0, claimed_by = NULL, lease_expires = NULL where {condition};",
+        parameters,
+    )
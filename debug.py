@@ -1,8 +1,11 @@
 import os
 import sqlite3
+import time
 from datetime import datetime
 from optparse import OptionParser
 
+from database import add_logs_to_download_queue, migrate_database
+
 db_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "db")
 
 
@@ -17,6 +20,7 @@ def main():
     else:
         db_file = os.path.join(db_folder, f"{opts.year}.db")
 
+    migrate_database(db_file)
     connection = sqlite3.connect(db_file)
 
     with connection:
@@ -31,19 +35,24 @@ def main():
         cursor.execute("SELECT COUNT(*) from logs where was_error = 1;")
         with_errors = cursor.fetchone()[0]
 
+        cursor.execute(
+            "SELECT COUNT(*) from logs where claimed_by IS NOT NULL and is_processed = 0 and lease_expires >= ?;",
+            [int(time.time())],
+        )
+        claimed = cursor.fetchone()[0]
+
         print("Total: {}".format(total))
         print("Processed: {}".format(processed))
         print("Unprocessed: {}".format(total - processed))
         print("With errors: {}".format(with_errors))
+        print("Claimed by running downloads: {}".format(claimed))
 
         if with_errors > 0:
             print("")
             print("WARNING!")
             print("There are {} records with errors".format(with_errors))
             print("It means that they weren't downloaded properly")
-            cursor.execute(
-                'UPDATE logs set is_processed = 0, was_error = 0, log_content="" where was_error = 1'
-            )
+            add_logs_to_download_queue(cursor, "was_error = 1")
             print("{} records were added to the download queue again".format(with_errors))
         else:
             print("")
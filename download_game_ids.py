@@ -6,13 +6,18 @@ Or it can be run to get data from previous years from .zip file.
 
 import calendar
 import gzip
+import hashlib
+import io
 import os
-import shutil
+import re
 import sqlite3
+import time
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-import requests
+from database import has_content_table, migrate_database
+from http_session import DEFAULT_TIMEOUT, TENHOU_URL, create_session
 
 
 class DownloadGameId(object):
@@ -20,13 +25,26 @@ class DownloadGameId(object):
     db_file = ""
     historical_download = None
     from_start = False
-
-    def __init__(self, logs_directory, db_file, year, from_start, extract_from_archive):
+    # url, ETag and Last-Modified of the last list.cgi response
+    validators = None
+
+    # example: 00:17 | 26 | 四鳳東喰赤－ | <a href="https://tenhou.net/0/?log=2009022023gm-00e1-0000-c603794d">牌譜</a> | ...
+    log_line_regex = re.compile(rb'^\s*(\d\d:\d\d)\s*\|[^|\n]*\|\s*([^|\n]*)\|[^\n]*?log=([^"\n]*)', re.M)
+    # the first and the third chars of game type
+    sanma_mark = "三".encode()
+    tonpusen_mark = "東".encode()
+    # example: list([{file:'scc2021010100.html.gz',size:3093},\r\n{file:'scc2021010101.html.gz',size:2987}]);
+    list_file_regex = re.compile(r"file:'([^']+)',size:(\d+)")
+
+    def __init__(
+        self, logs_directory, db_file, year, from_start, extract_from_archive, timeout=DEFAULT_TIMEOUT
+    ):
         """
-        :param logs_directory: directory where to store downloaded logs
+        :param logs_directory: directory with year archives
         :param db_file: to save log ids
         :param year: year for what we need to download data
         :param from_start: download logs from the start of the year
+        :param timeout: seconds to wait for tenhou.net response
         """
         self.logs_directory = logs_directory
         self.db_file = db_file
@@ -34,137 +52,163 @@ class DownloadGameId(object):
         self.from_start = from_start
         self.extract_from_archive = extract_from_archive
 
-        self.headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:47.0) Gecko/20100101 Firefox/47.0"
-        }
+        self.session = create_session(timeout)
 
     def process(self):
+        """
+        :return: count of inserted and skipped logs
+        """
         # for the initial set up
         if not os.path.exists(self.db_file):
             self.set_up_database()
 
+        migrate_database(self.db_file)
+
         if self.extract_from_archive:
-            records_was_added = self.process_year_archive(self.year)
-        else:
-            records_was_added = self.download_latest_games_id()
+            return self.add_logs_to_database(self.process_year_archive(self.year))
 
-        if records_was_added:
-            results = self.process_local_files()
-            if results:
-                self.add_logs_to_database(results)
+        results, files = self.download_latest_games_id()
+        counts = 0, 0
+        if files:
+            print("Found {} games in {} files".format(len(results), len(files)))
+            counts = self.add_logs_to_database(results)
+
+        self.save_downloaded_files(files)
+        return counts
 
     def download_latest_games_id(self):
         """
-        Download latest phoenix games from tenhou.net
+        Download scc files from tenhou.net list of the latest phoenix games.
+        Only files that are not in downloaded_files table or have a different size are downloaded,
+        and list.cgi itself is requested with ETag and Last-Modified of the previous response
+        :return: list of games and list of (name, size, checksum, logs_count) for downloaded files
         """
         connection = sqlite3.connect(self.db_file)
 
-        last_name = ""
+        if self.from_start:
+            url = f"{TENHOU_URL}/sc/raw/list.cgi?old"
+        else:
+            url = f"{TENHOU_URL}/sc/raw/list.cgi"
+
         with connection:
             cursor = connection.cursor()
-            cursor.execute("SELECT * FROM last_downloads ORDER BY date DESC LIMIT 1;")
-            data = cursor.fetchone()
-            if data:
-                last_name = data[0]
-                print("Latest downloaded archive: {}".format(last_name))
+            cursor.execute("SELECT name, size, checksum FROM downloaded_files;")
+            downloaded_files = {name: (size, checksum) for name, size, checksum in cursor.fetchall()}
 
-        download_url = "https://tenhou.net/sc/raw/dat/"
-        if self.from_start:
-            url = "https://tenhou.net/sc/raw/list.cgi?old"
-        else:
-            url = "https://tenhou.net/sc/raw/list.cgi"
-
-        response = requests.get(url, headers=self.headers)
-        response = response.text.replace("list(", "").replace(");", "")
-        response = response.split(",\r\n")
-
-        records_was_added = False
-        for archive_name in response:
-            if "scc" in archive_name:
-                archive_name = archive_name.split("',")[0].replace("{file:'", "")
-
-                file_name = archive_name
-                if "/" in file_name:
-                    file_name = file_name.split("/")[1]
-
-                if file_name > last_name:
-                    last_name = file_name
-                    records_was_added = True
-
-                    archive_path = os.path.join(self.logs_directory, file_name)
-                    if not os.path.exists(archive_path):
-                        print("Downloading... {}".format(archive_name))
-
-                        url = "{}{}".format(download_url, archive_name)
-                        page = requests.get(url, headers=self.headers)
-                        with open(archive_path, "wb") as f:
-                            f.write(page.content)
-
-        if records_was_added:
-            unix_time = calendar.timegm(datetime.utcnow().utctimetuple())
-            with connection:
-                cursor = connection.cursor()
-                cursor.execute("INSERT INTO last_downloads VALUES (?, ?);", [last_name, unix_time])
-        else:
-            print("There is no new logs")
+            # dbs before downloaded_files table remember only the latest processed file
+            cursor.execute("SELECT MAX(name) FROM last_downloads;")
+            last_name = cursor.fetchone()[0] or ""
 
-        return records_was_added
+            cursor.execute("SELECT etag, last_modified FROM http_validators WHERE url = ?;", [url])
+            validators = cursor.fetchone()
 
-    def process_year_archive(self, year):
-        archive_name = "scraw{}.zip".format(year)
+        connection.close()
 
-        archive_path = os.path.join(self.logs_directory, archive_name)
+        headers = {}
+        if validators and validators[0]:
+            headers["If-None-Match"] = validators[0]
+        if validators and validators[1]:
+            headers["If-Modified-Since"] = validators[1]
 
-        print("Extracting archive...")
-        with zipfile.ZipFile(archive_path) as zip_file:
-            for member in zip_file.namelist():
-                filename = os.path.basename(member)
-                # skip directories
-                if not filename:
+        self.validators = None
+        response = self.session.get(url, headers=headers)
+        if response.status_code == 304:
+            print("There is no new logs")
+            return [], []
+        response.raise_for_status()
+
+        results = []
+        files = []
+        failed_files = []
+        for archive_name, size in self.list_file_regex.findall(response.text):
+            if "scc" not in archive_name:
+                continue
+
+            file_name = os.path.basename(archive_name)
+            size = int(size)
+            if file_name in downloaded_files:
+                if downloaded_files[file_name][0] == size:
                     continue
+            elif file_name <= last_name:
+                continue
 
-                # copy file (taken from zipfile's extract)
-                source = zip_file.open(member)
-                target = open(os.path.join(self.logs_directory, filename), "wb")
-                with source, target:
-                    shutil.copyfileobj(source, target)
-        print("Extracted")
+            print("Downloading... {}".format(archive_name))
+            try:
+                file_response = self.session.get(f"{TENHOU_URL}/sc/raw/dat/{archive_name}")
+                file_response.raise_for_status()
+                content = file_response.content
+                checksum = hashlib.sha1(content).hexdigest()
+
+                games = []
+                # the same content with the other size in the list, there is nothing to parse
+                if file_name not in downloaded_files or downloaded_files[file_name][1] != checksum:
+                    games = list(self._process_log_file(io.BytesIO(content), file_name))
+            except Exception as e:
+                # error status or error page instead of gz file, the file is not added to downloaded_files
+                print(f"Failed {archive_name}: {repr(e)}")
+                failed_files.append(file_name)
+                continue
+
+            results.extend(games)
+            files.append((file_name, size, checksum, len(games)))
 
-        return True
+        if failed_files:
+            # without validators the next run requests list.cgi again instead of 304 and retries the files
+            print(f"{len(failed_files)} files weren't downloaded, they will be downloaded by the next run")
+        else:
+            self.validators = (url, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+        if not files:
+            print("There is no new logs")
 
-    def process_local_files(self):
+        return results, files
+
+    def save_downloaded_files(self, files):
         """
-        Function to process scc*.html files that can be obtained
-        from the annual archives with logs or from latest phoenix games api
+        Remember downloaded files and list.cgi validators,
+        it is called after the games were added to the db
+        :param files: list of (name, size, checksum, logs_count)
         """
-        print("Preparing the list of games...")
+        if not files and not self.validators:
+            return
 
-        results = []
-        for file_name in os.listdir(self.logs_directory):
-            if "scc" not in file_name:
-                continue
+        unix_time = calendar.timegm(datetime.utcnow().utctimetuple())
+        connection = sqlite3.connect(self.db_file)
 
-            # after 2013 tenhou produced compressed logs
-            if ".gz" in file_name:
-                with gzip.open(os.path.join(self.logs_directory, file_name), "r") as f:
-                    for line in f:
-                        line = str(line, "utf-8")
-                        result = self._process_log_line(line)
-                        if result:
-                            results.append(result)
-            else:
-                with open(os.path.join(self.logs_directory, file_name)) as f:
-                    for line in f:
-                        result = self._process_log_line(line)
-                        if result:
-                            results.append(result)
+        with connection:
+            cursor = connection.cursor()
+            cursor.executemany(
+                "INSERT OR REPLACE INTO downloaded_files (name, size, checksum, logs_count, downloaded_at) "
+                "VALUES (?, ?, ?, ?, ?);",
+                [file + (unix_time,) for file in files],
+            )
+            if self.validators:
+                cursor.execute(
+                    "INSERT OR REPLACE INTO http_validators (url, etag, last_modified) VALUES (?, ?, ?);",
+                    self.validators,
+                )
+
+        connection.close()
 
-        results = [x for x in results if x["game_date"][:4] == str(self.year)]
+    def process_year_archive(self, year):
+        """
+        Parse scc files right from the year archive without extracting them
+        :return: generator of games for the year
+        """
+        archive_name = "scraw{}.zip".format(year)
 
-        print("Found {} games".format(len(results)))
-        shutil.rmtree(self.logs_directory)
-        print("Temp folder was removed")
-        return results
+        archive_path = os.path.join(self.logs_directory, archive_name)
+
+        print("Reading archive {}...".format(archive_path))
+        with zipfile.ZipFile(archive_path) as zip_file:
+            for member in zip_file.namelist():
+                file_name = os.path.basename(member)
+                # skip directories and other files
+                if "scc" not in file_name:
+                    continue
+
+                with zip_file.open(member) as f:
+                    yield from self._process_log_file(f, file_name)
 
     def set_up_database(self):
         """
@@ -184,8 +228,17 @@ class DownloadGameId(object):
                 is_tonpusen int,
                 is_sanma int,
                 is_processed int,
-                was_error int,
-                log_content text
+                was_error int
+            );
+            """
+            )
+
+            # compressed logs are stored separately from the metadata
+            cursor.execute(
+                """
+            CREATE TABLE logs_content(
+                log_id text primary key,
+                log_content blob
             );
             """
             )
@@ -196,48 +249,147 @@ class DownloadGameId(object):
             """
             )
 
+        migrate_database(self.db_file)
+
     def add_logs_to_database(self, results):
         """
-        Store logs to the sqllite3 database
+        Store logs to the sqllite3 database.
+        Already added log ids are skipped, so it is safe to add the same logs again
+        :param results: iterable of (log_id, game_date, is_tonpusen, is_sanma) tuples, it can be a generator
+        :return: count of inserted and skipped logs
         """
         print("Inserting new ids to the database...")
         connection = sqlite3.connect(self.db_file)
-        with connection:
-            cursor = connection.cursor()
+        # settings for the bulk load
+        connection.execute("PRAGMA journal_mode=WAL;")
+        connection.execute("PRAGMA synchronous=NORMAL;")
+        connection.execute("PRAGMA cache_size=-65536;")
 
+        total = 0
+
+        def rows():
+            nonlocal total
             for item in results:
-                cursor.execute(
-                    "INSERT INTO logs (log_id, date, is_tonpusen, is_sanma, is_processed, was_error, log_content)"
-                    'VALUES (?, ?, ?, ?, 0, 0, "");',
-                    [
-                        item["log_id"],
-                        item["game_date"],
-                        item["is_tonpusen"] and 1 or 0,
-                        item["is_sanma"] and 1 or 0,
-                    ],
+                total += 1
+                yield item
+
+        with connection:
+            if has_content_table(connection.cursor()):
+                query = (
+                    "INSERT OR IGNORE INTO logs (log_id, date, is_tonpusen, is_sanma, is_processed, was_error)"
+                    "VALUES (?, ?, ?, ?, 0, 0);"
+                )
+            else:
+                query = (
+                    "INSERT OR IGNORE INTO logs (log_id, date, is_tonpusen, is_sanma, is_processed, was_error, log_content)"
+                    'VALUES (?, ?, ?, ?, 0, 0, "");'
                 )
-        print("Done")
 
-    def _process_log_line(self, line):
-        line = line.strip()
-        # sometimes there is empty lines in the file
-        if not line:
-            return None
+            changes_before = connection.total_changes
+            connection.executemany(query, rows())
+            inserted = connection.total_changes - changes_before
 
-        result = line.split("|")
-        game_type = result[2].strip()
+        skipped = total - inserted
+        print(f"Inserted {inserted} new ids, skipped {skipped} already added ids")
+        return inserted, skipped
 
-        is_sanma = game_type.startswith("三")
+    def _process_log_file(self, f, file_name):
+        """
+        Parse all games from scc file content at once
+        :param f: binary file object with scc file content
+        :return: generator of (log_id, game_date, is_tonpusen, is_sanma) tuples for the target year
+        """
+        # after 2013 tenhou produced compressed logs
+        if ".gz" in file_name:
+            f = gzip.open(f, "r")
+
+        with f:
+            content = f.read()
+
+        # without the year all games are added
+        year = str(self.year or "").encode()
+        for game_time, game_type, log_id in self.log_line_regex.findall(content):
+            # log id starts with the game date
+            if not log_id.startswith(year):
+                continue
 
-        # example: <a href="https://tenhou.net/0/?log=2009022023gm-00e1-0000-c603794d">牌譜</a>
-        log_id = result[3].split("log=")[1].split('"')[0]
+            # sqlite date format
+            game_date = b"%s-%s-%s %s" % (log_id[0:4], log_id[4:6], log_id[6:8], game_time)
+
+            yield (
+                log_id.decode(),
+                game_date.decode(),
+                game_type[6:9] == self.tonpusen_mark and 1 or 0,
+                game_type.startswith(self.sanma_mark) and 1 or 0,
+            )
 
-        # example: 四鳳東喰赤
-        is_tonpusen = game_type[2] == "東"
 
-        # parse date from log id and convert it to sqlite date format
-        game_date = datetime.strptime(
-            log_id.split("gm-")[0][0:8] + result[0].strip(), "%Y%m%d%H:%M"
-        ).strftime("%Y-%m-%d %H:%M")
+def parse_years(years):
+    """
+    :param years: range like 2009-2024 or list like 2009,2012
+    :return: list of years
+    """
+    result = []
+    for part in years.split(","):
+        if "-" in part:
+            first_year, last_year = part.split("-")
+            result.extend([str(x) for x in range(int(first_year), int(last_year) + 1)])
+        else:
+            result.append(part.strip())
+    return result
+
+
+def process_year_archives(logs_directory, db_folder, years, workers):
+    """
+    Add log ids from several year archives in parallel processes.
+    Archives are read in place and each year has its own db, so workers share nothing
+    """
+    start_time = datetime.now()
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(process_year_archive, logs_directory, os.path.join(db_folder, f"{year}.db"), year)
+            for year in years
+        ]
+        results = [x.result() for x in futures]
+
+    print("")
+    print("Year  Inserted   Skipped  Seconds")
+    for result in results:
+        if result["error"]:
+            print("{}  {}".format(result["year"], result["error"]))
+        else:
+            print(
+                "{}  {:>8}  {:>8}  {:>7.1f}".format(
+                    result["year"], result["inserted"], result["skipped"], result["seconds"]
+                )
+            )
 
-        return {"log_id": log_id, "is_tonpusen": is_tonpusen, "is_sanma": is_sanma, "game_date": game_date}
+    print(
+        "Total: {} inserted, {} skipped".format(
+            sum([x["inserted"] for x in results]), sum([x["skipped"] for x in results])
+        )
+    )
+    print("Worked time: {} seconds".format((datetime.now() - start_time).seconds))
+
+
+def process_year_archive(logs_directory, db_file, year):
+    """
+    Worker of process_year_archives
+    :return: dict with year results
+    """
+    result = {"year": year, "inserted": 0, "skipped": 0, "seconds": 0, "error": None}
+    if not os.path.exists(os.path.join(logs_directory, f"scraw{year}.zip")):
+        result["error"] = f"There is no temp/scraw{year}.zip archive"
+        return result
+
+    start_time = time.perf_counter()
+    try:
+        result["inserted"], result["skipped"] = DownloadGameId(
+            logs_directory, db_file, year, False, True
+        ).process()
+    except Exception as e:
+        result["error"] = repr(e)
+
+    result["seconds"] = time.perf_counter() - start_time
+    return result
@@ -1,24 +1,535 @@
 """
 Script will load log ids from the database and will download log content
 """
-import gzip
+import calendar
+import multiprocessing
+import os
+import queue
 import re
+import signal
+import socket
 import sqlite3
 import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from urllib.parse import urlsplit
 
-import requests
+from catalog import Catalog
+from compression import GZIP_CODEC, LogCompressor, create_compressor
+from database import migrate_database, store_log_contents
+from http_session import DEFAULT_TIMEOUT, TENHOU_URL, create_session
+from metrics import Metrics, MetricsWriter
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared between all download threads,
+    it limits requests per second no matter how many threads we have
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: allowed requests per second, 0 to disable the limit
+        :param burst: how many requests can be done at once after idle time
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, stop_event):
+        """
+        Wait for the next free request slot
+        :return: False if we were stopped while waiting
+        """
+        if not self.rate:
+            return not stop_event.is_set()
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return not stop_event.is_set()
+
+                wait_time = (1 - self.tokens) / self.rate
+
+            if stop_event.wait(wait_time):
+                return False
+
+    def on_response(self, started_at, seconds, status):
+        """
+        Fixed rate doesn't depend on responses
+        """
+        return None
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    AIMD rate control on top of the token bucket.
+    The rate grows by increase_step after each second of successful requests and it is
+    multiplied by decrease_factor after throttling, error pages, failed requests
+    or when responses become much slower than the fastest ones
+    """
+
+    # requests per second
+    increase_step = 0.1
+    decrease_factor = 0.5
+    # smoothed latency that is latency_factor times higher than the best one means overloaded server,
+    # but only if it is higher than min_slow_latency seconds, small latencies are just noisy
+    latency_factor = 4
+    min_slow_latency = 1
+    # weight of the latest response in the smoothed latency
+    latency_weight = 0.2
+
+    def __init__(self, rate, min_rate=0.1, max_rate=10):
+        """
+        :param rate: the starting rate
+        :param min_rate: the rate never goes below it
+        :param max_rate: the rate never goes above it
+        """
+        super().__init__(min(max(rate, min_rate), max_rate))
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.successes = 0
+        self.decreased_at = 0
+        self.min_latency = None
+        self.latency = None
+
+    def on_response(self, started_at, seconds, status):
+        """
+        :param started_at: time.monotonic() before the request
+        :param seconds: how long the request took
+        :param status: ok, throttled, error_page or failed
+        :return: the new rate if it was changed, otherwise None
+        """
+        with self.lock:
+            if status != "ok":
+                return self._decrease(started_at)
+
+            if self.min_latency is None or seconds < self.min_latency:
+                self.min_latency = seconds
+            if self.latency is None:
+                self.latency = seconds
+            self.latency += (seconds - self.latency) * self.latency_weight
+
+            if self.latency > max(self.min_latency * self.latency_factor, self.min_slow_latency):
+                return self._decrease(started_at)
+
+            self.successes += 1
+            if self.successes < self.rate or self.rate >= self.max_rate:
+                return None
+
+            self.successes = 0
+            self.rate = min(round(self.rate + self.increase_step, 2), self.max_rate)
+            return self.rate
+
+    def _decrease(self, started_at):
+        # requests sent before the last decrease show the old rate,
+        # so a burst of errors is one decrease and not the drop to min_rate
+        if started_at < self.decreased_at:
+            return None
+
+        self.decreased_at = time.monotonic()
+        self.successes = 0
+        self.latency = None
+        self.rate = max(self.rate * self.decrease_factor, self.min_rate)
+        return self.rate
+
+
+class DatabaseWriter(threading.Thread):
+    """
+    The only thread that writes downloaded logs to the db.
+    Download threads put results to its queue and it commits them in batches,
+    so we don't pay for the commit and the db lock for each log
+    """
+
+    # seconds to wait for the db lock of other writers, e.g. other download processes
+    busy_timeout = 30
+    # failed commits are retried after 1, 2, 4... seconds
+    write_retries = 5
+
+    def __init__(self, db_file, commit_size, commit_interval, stats=None, stop_event=None, *args, **kwargs):
+        """
+        :param commit_size: commit after this count of logs
+        :param commit_interval: or after this count of seconds
+        :param stats: PipelineStats to count written logs
+        :param stop_event: it is set when logs can't be written, so the downloads stop
+        """
+        super().__init__(*args, **kwargs)
+
+        self.db_file = db_file
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        self.stats = stats
+        self.stop_event = stop_event
+        # after the failure logs are taken from the queue and dropped, so producers don't wait forever,
+        # dropped logs stay not processed in the db
+        self.failed = False
+        # producers wait when the writer is behind, so logs don't pile up in memory
+        self.queue = queue.Queue(maxsize=commit_size * 2)
+
+    def put(self, log_id, was_error, compressed_content, content_codec):
+        self.queue.put((log_id, was_error, compressed_content, content_codec))
+
+    def stop(self):
+        """
+        Write all remaining logs and wait for the thread
+        """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        connection = sqlite3.connect(self.db_file, timeout=self.busy_timeout)
+        try:
+            # with WAL commits don't wait for the fsync of the whole db,
+            # and NORMAL synchronous is safe for it
+            connection.execute("PRAGMA journal_mode=WAL;")
+            connection.execute("PRAGMA synchronous=NORMAL;")
+        except sqlite3.OperationalError as e:
+            self.fail(e)
+
+        rows = []
+        last_commit_time = time.monotonic()
+        while True:
+            timeout = max(0, self.commit_interval - (time.monotonic() - last_commit_time))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if item:
+                rows.append(item)
+
+            is_time_to_commit = time.monotonic() - last_commit_time >= self.commit_interval
+            if rows and (item is None or len(rows) >= self.commit_size or is_time_to_commit):
+                if not self.failed:
+                    self.write(connection, rows)
+                rows = []
+
+            if item is None or is_time_to_commit:
+                last_commit_time = time.monotonic()
+
+            if item is None:
+                break
+
+        connection.close()
+
+    def write(self, connection, rows):
+        start_time = time.perf_counter()
+        for attempt in range(self.write_retries + 1):
+            try:
+                with connection:
+                    store_log_contents(connection.cursor(), rows)
+                break
+            except sqlite3.OperationalError as e:
+                if attempt == self.write_retries:
+                    self.fail(e)
+                    return
+
+                delay = 2**attempt
+                print(f"Can't write logs to the db: {e}, retry in {delay} seconds")
+                time.sleep(delay)
+
+        if self.stats:
+            self.stats.add("write", time.perf_counter() - start_time, len(rows))
+
+    def fail(self, error):
+        print(f"Can't write logs to the db: {error}, stopping the download")
+        self.failed = True
+        if self.stop_event:
+            self.stop_event.set()
+
+
+class PipelineStats(object):
+    """
+    Counters of the download pipeline: fetch, compress and write stages.
+    For each stage we count processed logs and the time spent on them
+    """
+
+    stages = ["fetch", "compress", "write"]
+
+    def __init__(self, metrics=None):
+        """
+        :param metrics: Metrics for the latency histograms of the stages
+        """
+        self.metrics = metrics or Metrics("content")
+        self.start_time = time.monotonic()
+        self.counts = {stage: 0 for stage in self.stages}
+        self.busy_time = {stage: 0 for stage in self.stages}
+        # queues between the stages, their depth shows the slowest stage
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, count=1):
+        """
+        :param seconds: time of one request, one compression or one commit
+        """
+        with self.lock:
+            self.counts[stage] += count
+            self.busy_time[stage] += seconds
+        self.metrics.observe(f"{stage}_seconds", seconds)
+
+    def update_gauges(self):
+        elapsed = max(time.monotonic() - self.start_time, 0.001)
+        stored_bytes = self.metrics.counter("stored_bytes")
+        self.metrics.set("logs_per_second", self.counts["write"] / elapsed)
+        self.metrics.set(
+            "compression_ratio", stored_bytes and self.metrics.counter("raw_bytes") / stored_bytes or 0
+        )
+        for name, x in self.queues.items():
+            self.metrics.set("queue_size", x.qsize(), {"queue": name})
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start_time, 0.001)
+        with self.lock:
+            stages = [
+                "{} {} ({:.1f}/s, {:.0f} ms each)".format(
+                    stage,
+                    self.counts[stage],
+                    self.counts[stage] / elapsed,
+                    self.counts[stage] and self.busy_time[stage] / self.counts[stage] * 1000 or 0,
+                )
+                for stage in self.stages
+            ]
+        queues = ["{} {}/{}".format(name, x.qsize(), x.maxsize) for name, x in self.queues.items()]
+        return "Stages: {}. Queues: {}".format(", ".join(stages), ", ".join(queues))
+
+
+class StatsReporter(threading.Thread):
+    """
+    Print pipeline stats and write metrics each interval seconds and once more at the end
+    """
+
+    def __init__(self, stats, interval, metrics_writer=None, *args, **kwargs):
+        """
+        :param metrics_writer: MetricsWriter to write metrics together with the report
+        """
+        super().__init__(*args, daemon=True, **kwargs)
+        self.stats = stats
+        self.interval = interval
+        self.metrics_writer = metrics_writer
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        self.report()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def report(self):
+        print(self.stats.report())
+        if self.metrics_writer:
+            self.stats.update_gauges()
+            self.metrics_writer.write()
+
+
+class LeaseKeeper(threading.Thread):
+    """
+    Extend the leases of the claimed logs while the download is running,
+    so other processes don't take them. If the process is killed, the leases expire
+    """
+
+    def __init__(self, db_file, worker_id, lease_time, *args, **kwargs):
+        """
+        :param worker_id: claimed_by value of this process
+        :param lease_time: seconds, leases are extended each third of it
+        """
+        super().__init__(*args, daemon=True, **kwargs)
+        self.db_file = db_file
+        self.worker_id = worker_id
+        self.lease_time = lease_time
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.lease_time / 3):
+            try:
+                self.extend()
+            except sqlite3.OperationalError as e:
+                # the db can be locked by other writers, the next attempt is before the lease expires
+                print(f"Leases weren't extended: {e}")
+
+    def extend(self):
+        connection = sqlite3.connect(self.db_file)
+        with connection:
+            connection.execute(
+                "UPDATE logs SET lease_expires = ? WHERE claimed_by = ? and is_processed = 0;",
+                [int(time.time()) + self.lease_time, self.worker_id],
+            )
+        connection.close()
+
+
+def is_log_content(status_code, binary_content):
+    """
+    Tenhou can answer with an error page instead of the log, both engines check responses with it
+    """
+    return status_code == 200 and b"mjlog" in binary_content
+
+
+def response_status(status_code, was_error):
+    """
+    :return: ok, throttled or error_page status of the response for the rate limiter
+    """
+    if status_code == 429 or status_code >= 500:
+        return "throttled"
+    if was_error:
+        return "error_page"
+    return "ok"
+
+
+# compressor of the compression worker process
+log_compressor = None
+strip_shuffle = False
+
+
+def init_compression(dictionaries, codec, strip_logs):
+    global log_compressor, strip_shuffle
+    # on Ctrl-C the main process stores already downloaded logs, workers have to compress them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_compressor = LogCompressor(dictionaries, codec)
+    strip_shuffle = strip_logs
+
+
+def compress_log(binary_content):
+    """
+    Strip and compress log in the worker process
+    """
+    return strip_and_compress(log_compressor, strip_shuffle, binary_content)
+
+
+def strip_and_compress(compressor, strip_logs, binary_content):
+    """
+    :return: codec, compressed content, size of the stripped log and seconds spent
+    """
+    start_time = time.perf_counter()
+    if strip_logs:
+        binary_content = re.sub(DownloadLogContent.shuffle_regex, b"", binary_content)
+
+    content_codec, compressed_content = compressor.compress(binary_content)
+    return content_codec, compressed_content, len(binary_content), time.perf_counter() - start_time
+
+
+class CompressionStage(threading.Thread):
+    """
+    Strip and compress downloaded logs in the process pool and pass them to the writer in order.
+    Its queue is bounded, so download threads wait if compression is behind,
+    but the network doesn't wait for the compression of each log.
+    Without workers logs are compressed by the download threads and the pool isn't started
+    """
+
+    def __init__(self, compressor, strip_logs, workers, writer, stats, *args, **kwargs):
+        """
+        :param workers: count of compression processes, 0 to compress in the calling thread
+        """
+        super().__init__(*args, **kwargs)
+
+        self.compressor = compressor
+        self.strip_logs = strip_logs
+        self.workers = workers
+        self.writer = writer
+        self.stats = stats
+        self.queue = queue.Queue(maxsize=workers * 4)
+
+        self.executor = None
+        if workers:
+            # workers are started when download threads are already running,
+            # fork could copy a lock held by another thread, so we use spawn
+            self.executor = ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_compression,
+                initargs=(compressor.dictionaries, compressor.codec, strip_logs),
+            )
+
+    def put(self, log_id, binary_content, was_error):
+        if self.executor:
+            self.queue.put((log_id, binary_content, was_error))
+            return
+
+        if was_error:
+            self.store(log_id, None)
+        else:
+            self.store(log_id, lambda: strip_and_compress(self.compressor, self.strip_logs, binary_content))
+
+    def stop(self):
+        """
+        Compress all remaining logs and wait for the thread
+        """
+        self.queue.put(None)
+        self.join()
+        if self.executor:
+            self.executor.shutdown()
+
+    def run(self):
+        futures = deque()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            log_id, binary_content, was_error = item
+            future = None
+            if not was_error:
+                try:
+                    future = self.executor.submit(compress_log, binary_content)
+                except Exception as e:
+                    # the pool is broken, the log will be stored as the failed one
+                    print(e)
+            futures.append((log_id, future and future.result))
+
+            # keep workers busy, but don't let compressed logs pile up
+            while len(futures) > self.workers * 2:
+                self.store(*futures.popleft())
+
+        while futures:
+            self.store(*futures.popleft())
+
+    def store(self, log_id, get_result):
+        """
+        :param get_result: returns the result of strip_and_compress, None for the failed download
+        """
+        if get_result is None:
+            self.writer.put(log_id, True, "", GZIP_CODEC)
+            return
+
+        try:
+            content_codec, compressed_content, raw_size, seconds = get_result()
+        except Exception as e:
+            print(e)
+            print("Cant compress log content")
+            self.stats.metrics.inc("errors", labels={"error_class": "compression"})
+            self.writer.put(log_id, True, "", GZIP_CODEC)
+            return
+
+        self.stats.add("compress", seconds)
+        self.stats.metrics.inc("raw_bytes", raw_size)
+        self.stats.metrics.inc("stored_bytes", len(compressed_content))
+        self.stats.metrics.inc("stored_logs")
+        self.writer.put(log_id, False, compressed_content, content_codec)
 
 
 class DownloadThread(threading.Thread):
-    def __init__(self, downloader, results, *args, **kwargs):
+    def __init__(self, downloader, queue, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.downloader = downloader
-        self.results = results
+        self.queue = queue
 
     def run(self):
-        self.downloader.download_logs(self.results)
+        self.downloader.download_logs(self.queue)
 
 
 class DownloadLogContent(object):
@@ -26,17 +537,94 @@ class DownloadLogContent(object):
     limit = 0
     threads = 0
     strip_logs = False
+    rate = 0
+    retries = 0
+    commit_size = 0
+    commit_interval = 0
+    compress_workers = 0
+
+    # seconds between pipeline stats reports
+    report_interval = 10
+
+    # seconds, retry delay is doubled after each attempt
+    retry_delay = 1
+    max_retry_delay = 60
+
+    # requests per second to start adaptive rate control without the learned rate and -r
+    default_adaptive_rate = 1
 
     shuffle_regex = rb"<SHUFFLE[^>]*>"
 
-    def __init__(self, db_file, limit, threads, strip_logs):
+    def __init__(
+        self,
+        db_file,
+        limit,
+        threads,
+        strip_logs,
+        rate=1.0,
+        retries=3,
+        commit_size=100,
+        commit_interval=5,
+        timeout=DEFAULT_TIMEOUT,
+        codec="gzip",
+        catalog_file=None,
+        compress_workers=0,
+        metrics_file=None,
+        prometheus_file=None,
+        adaptive=False,
+        max_rate=10,
+        worker_id=None,
+        lease_time=600,
+    ):
         """
         :param db_file: db with loaded log ids
+        :param rate: requests per second for all threads together
+        :param retries: how many times to retry failed log download
+        :param commit_size: how many logs to store in the db in one commit
+        :param commit_interval: max seconds between commits
+        :param timeout: seconds to wait for tenhou.net response
+        :param codec: gzip or zstd to compress logs
+        :param catalog_file: catalog to copy logs that were already downloaded to other dbs
+        :param compress_workers: count of processes to strip and compress logs, 0 to do it in download threads
+        :param metrics_file: JSON lines file for the metrics
+        :param prometheus_file: Prometheus textfile for the metrics
+        :param adaptive: adjust the rate to throttling and error pages, rate is the starting one then
+        :param max_rate: the highest rate for adaptive rate control
+        :param worker_id: name of this process in the claims of logs, host and pid by default
+        :param lease_time: seconds before claims of the killed process can be taken by others
         """
         self.db_file = db_file
         self.limit = limit
         self.threads = threads
         self.strip_logs = strip_logs
+        self.rate = rate
+        self.retries = retries
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        self.timeout = timeout
+        self.codec = codec
+        self.catalog_file = catalog_file
+        self.compress_workers = compress_workers
+        self.metrics_file = metrics_file
+        self.prometheus_file = prometheus_file
+        self.adaptive = adaptive
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_time = lease_time
+
+        # threads share keep-alive connections,
+        # failed requests are retried by download_log_content with our backoff
+        self.session = create_session(timeout, retries=0, pool_size=threads)
+        self.writer = None
+        self.compression_stage = None
+        self.stats_reporter = None
+        self.lease_keeper = None
+        self.stats = PipelineStats()
+        self.compressor = None
+        if adaptive:
+            self.rate_limiter = AdaptiveRateLimiter(rate or self.default_adaptive_rate, max_rate=max_rate)
+        else:
+            self.rate_limiter = RateLimiter(rate)
+        self.stop_event = threading.Event()
 
     def process(self):
         start_time = datetime.now()
@@ -46,38 +634,105 @@ class DownloadLogContent(object):
             print("Nothing to download")
             return
 
+        try:
+            self.download_claimed_logs(results)
+        finally:
+            # other processes can take not downloaded logs right away, without waiting for the leases
+            self.release_claims()
+
+        print("Worked time: {} seconds".format((datetime.now() - start_time).seconds))
+
+    def download_claimed_logs(self, results):
+        self.compressor = create_compressor(self.db_file, self.codec)
+        if not self.compressor:
+            return
+
+        results = self.copy_downloaded_logs(results)
+        if not results:
+            print("Nothing to download")
+            return
+
         total_results = len(results)
         if total_results < self.limit:
             print("We have only {} records to download".format(total_results))
             self.limit = total_results
 
-        # separate array to parts and download them simultaneously
-        threads = []
-        part = int(self.limit / self.threads)
-        for x in range(0, self.threads):
-            start = x * part
-            if (x + 1) != self.threads:
-                end = (x + 1) * part
-            else:
-                # we had to add all remaining items to the last thread
-                # for example with limit=81, threads=4 results will be distributed:
-                # 20 20 20 21
-                end = self.limit
-
-            threads.append(DownloadThread(self, results[start:end]))
+        self.start_pipeline()
+        # after the pipeline, so the starting rate goes to the metrics of this run
+        self.load_learned_rate()
+        self.download_all_logs(results)
+        self.stop_pipeline()
+        self.save_learned_rate()
+
+    def download_all_logs(self, results):
+        """
+        Download logs with the threads, they pass logs to the pipeline.
+        It returns when all logs are downloaded or after Ctrl-C
+        """
+        # threads take log ids from the shared queue,
+        # so one slow thread doesn't hold up the others
+        logs_queue = queue.Queue()
+        for log_id in results:
+            logs_queue.put(log_id)
+
+        threads = [DownloadThread(self, logs_queue) for _ in range(self.threads)]
 
         # let's start all threads
         for t in threads:
             t.start()
 
         # let's wait while all threads will be finished
-        for t in threads:
-            t.join()
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(0.5)
+        except KeyboardInterrupt:
+            print("Stopping... Waiting for the current downloads")
+            self.stop_event.set()
+            for t in threads:
+                t.join()
 
-        print("Worked time: {} seconds".format((datetime.now() - start_time).seconds))
+    def start_pipeline(self):
+        """
+        Download threads put logs to the compression stage,
+        it passes compressed logs to the writer
+        """
+        self.stats = PipelineStats()
+        self.writer = DatabaseWriter(
+            self.db_file, self.commit_size, self.commit_interval, self.stats, self.stop_event
+        )
+        self.compression_stage = CompressionStage(
+            self.compressor, self.strip_logs, self.compress_workers, self.writer, self.stats
+        )
+        self.stats.queues = {"compress": self.compression_stage.queue, "write": self.writer.queue}
+        metrics_writer = MetricsWriter(self.stats.metrics, self.metrics_file, self.prometheus_file)
+        self.stats_reporter = StatsReporter(self.stats, self.report_interval, metrics_writer)
+        self.lease_keeper = LeaseKeeper(self.db_file, self.worker_id, self.lease_time)
+
+        self.writer.start()
+        self.compression_stage.start()
+        self.stats_reporter.start()
+        self.lease_keeper.start()
+
+    def stop_pipeline(self):
+        """
+        Store all downloaded logs and stop the stages
+        """
+        self.compression_stage.stop()
+        self.writer.stop()
+        self.stats_reporter.stop()
+        self.lease_keeper.stop()
+
+    def download_logs(self, logs_queue):
+        while not self.stop_event.is_set():
+            try:
+                log_id = logs_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if not self.rate_limiter.acquire(self.stop_event):
+                break
 
-    def download_logs(self, results):
-        for log_id in results:
             try:
                 print("Process {}".format(log_id))
                 self.download_log_content(log_id)
@@ -86,64 +741,193 @@ class DownloadLogContent(object):
 
     def download_log_content(self, log_id):
         """
-        Download log content and store compressed version in the db
+        Download log content and store compressed version in the db.
+        If the download was stopped during the retry, the log isn't stored and stays in the queue
         """
-        url = f"https://tenhou.net/0/log/?{log_id}"
+        binary_content, was_error = self.request_log_content(log_id)
 
+        for attempt in range(self.retries):
+            if not was_error:
+                break
+
+            delay = min(self.retry_delay * 2**attempt, self.max_retry_delay)
+            print(f"Retry {log_id} in {delay} seconds")
+            if self.stop_event.wait(delay) or not self.rate_limiter.acquire(self.stop_event):
+                return
+
+            binary_content, was_error = self.request_log_content(log_id)
+
+        self.store_log_content(log_id, binary_content, was_error)
+
+    def request_log_content(self, log_id):
+        url = f"{TENHOU_URL}/0/log/?{log_id}"
+
+        start_time = time.monotonic()
         binary_content = None
         was_error = False
         try:
-            response = requests.get(
-                url,
-                headers={
-                    "User-Agent": "Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:47.0) Gecko/20100101 Firefox/47.0"
-                },
-            )
+            response = self.session.get(url)
             binary_content = response.content
-            # it can be an error page
-            if "mjlog" not in response.text:
+            if not is_log_content(response.status_code, binary_content):
                 print("There is no log content in response")
                 was_error = True
+                self.stats.metrics.inc(
+                    "errors", labels={"error_class": f"no_log_content_{response.status_code}"}
+                )
+            status = response_status(response.status_code, was_error)
         except Exception as e:
             print(e)
             was_error = True
+            self.stats.metrics.inc("errors", labels={"error_class": e.__class__.__name__})
+            status = "failed"
 
-        if self.strip_logs:
-            binary_content = self.strip_log_tags(binary_content)
+        self.stats.add("fetch", time.monotonic() - start_time)
+        self.update_rate(start_time, status)
+        self.stats.metrics.inc("fetched_bytes", binary_content and len(binary_content) or 0)
+        return binary_content, was_error
 
-        connection = sqlite3.connect(self.db_file)
+    def update_rate(self, started_at, status):
+        """
+        Pass the response to the rate limiter
+        :param started_at: time.monotonic() before the request
+        :param status: ok, throttled, error_page or failed
+        """
+        rate = self.rate_limiter.on_response(started_at, time.monotonic() - started_at, status)
+        if rate is None:
+            return
 
+        self.stats.metrics.set("request_rate", rate)
+        if status != "ok":
+            self.stats.metrics.inc("rate_decreases")
+            print(f"Request rate is decreased to {rate:.2f}/s after {status} response")
+
+    def load_learned_rate(self):
+        """
+        Start adaptive rate control from the rate of the previous run with the same server
+        """
+        if not self.adaptive:
+            return
+
+        connection = sqlite3.connect(self.db_file)
         with connection:
             cursor = connection.cursor()
+            cursor.execute("SELECT rate FROM learned_rates WHERE host = ?;", [self.rate_host()])
+            row = cursor.fetchone()
+        connection.close()
 
-            compressed_content = ""
-            if not was_error:
-                try:
-                    compressed_content = gzip.compress(binary_content)
-                except Exception as e:
-                    print(e)
-                    print("Cant compress log content")
-                    was_error = True
+        if row:
+            limiter = self.rate_limiter
+            limiter.rate = min(max(row[0], limiter.min_rate), limiter.max_rate)
+            print(f"Starting from the learned rate {limiter.rate:.2f} requests per second")
+        self.stats.metrics.set("request_rate", self.rate_limiter.rate)
 
-            cursor.execute(
-                "UPDATE logs SET is_processed = ?, was_error = ?, log_content = ? WHERE log_id = ?;",
-                [1, was_error and 1 or 0, compressed_content, log_id],
+    def save_learned_rate(self):
+        if not self.adaptive:
+            return
+
+        unix_time = calendar.timegm(datetime.utcnow().utctimetuple())
+        connection = sqlite3.connect(self.db_file)
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO learned_rates (host, rate, updated_at) VALUES (?, ?, ?);",
+                [self.rate_host(), self.rate_limiter.rate, unix_time],
             )
+        connection.close()
+        print(f"Learned rate: {self.rate_limiter.rate:.2f} requests per second")
+
+    def rate_host(self):
+        return urlsplit(TENHOU_URL).netloc
+
+    def store_log_content(self, log_id, binary_content, was_error):
+        """
+        Pass the log to the compression stage, it waits if the stage queue is full
+        """
+        self.compression_stage.put(log_id, binary_content, was_error)
 
     def strip_log_tags(self, log_content):
         # for now only strip shuffle seed
         return re.sub(self.shuffle_regex, b"", log_content)
 
+    def copy_downloaded_logs(self, log_ids):
+        """
+        Copy logs that were already downloaded to other dbs of the catalog
+        :return: log ids that still have to be downloaded
+        """
+        if not self.catalog_file:
+            return log_ids
+
+        catalog = Catalog(self.catalog_file)
+        locations = catalog.find_downloaded(log_ids, self.db_file)
+        connection = sqlite3.connect(self.db_file, timeout=DatabaseWriter.busy_timeout)
+
+        copied_log_ids = set()
+        rows = []
+        for i, (log_id, db_file) in enumerate(locations.items()):
+            log_content = catalog.get_log(log_id, db_file)
+            if log_content is not None:
+                if self.strip_logs:
+                    log_content = self.strip_log_tags(log_content)
+
+                codec, compressed_content = self.compressor.compress(log_content)
+                rows.append((log_id, False, compressed_content, codec))
+
+            # logs are written by batches like in DatabaseWriter, so they don't pile up in memory
+            if rows and (len(rows) >= self.commit_size or i == len(locations) - 1):
+                with connection:
+                    store_log_contents(connection.cursor(), rows)
+                copied_log_ids.update([x[0] for x in rows])
+                rows = []
+
+        connection.close()
+        catalog.close()
+
+        if copied_log_ids:
+            print(f"Copied {len(copied_log_ids)} logs from other dbs of the catalog")
+
+        return [x for x in log_ids if x not in copied_log_ids]
+
     def load_not_processed_logs(self):
+        """
+        Claim not processed logs for this process, so concurrent downloads to the same db
+        don't download the same logs. Logs claimed by other processes are skipped
+        until their leases expire
+        :return: list of claimed log ids
+        """
+        migrate_database(self.db_file)
+
         connection = sqlite3.connect(self.db_file)
+        now = int(time.time())
 
         with connection:
             cursor = connection.cursor()
+            # the write lock from the start, so other processes can't claim the same logs between queries
+            cursor.execute("BEGIN IMMEDIATE;")
+            cursor.execute(
+                "UPDATE logs SET claimed_by = ?, lease_expires = ? WHERE log_id IN ("
+                "SELECT log_id FROM logs where is_processed = 0 and was_error = 0 "
+                "and (lease_expires IS NULL or lease_expires < ?) ORDER BY log_id LIMIT ?);",
+                [self.worker_id, now + self.lease_time, now, self.limit],
+            )
             cursor.execute(
-                "SELECT log_id FROM logs where is_processed = 0 and was_error = 0 ORDER BY log_id LIMIT ?;",
-                [self.limit],
+                "SELECT log_id FROM logs where claimed_by = ? and is_processed = 0 and was_error = 0 "
+                "ORDER BY log_id;",
+                [self.worker_id],
             )
             data = cursor.fetchall()
             results = [x[0] for x in data]
 
+        connection.close()
+        print(f"Claimed {len(results)} logs as {self.worker_id}")
         return results
+
+    def release_claims(self):
+        connection = sqlite3.connect(self.db_file, timeout=DatabaseWriter.busy_timeout)
+        try:
+            with connection:
+                connection.execute(
+                    "UPDATE logs SET claimed_by = NULL, lease_expires = NULL WHERE claimed_by = ?;",
+                    [self.worker_id],
+                )
+        except sqlite3.OperationalError as e:
+            print(f"Claims weren't released: {e}, they will expire in {self.lease_time} seconds")
+        connection.close()
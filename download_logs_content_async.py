@@ -0,0 +1,250 @@
+"""
+asyncio engine to download log content.
+Requests are sent at exact intervals, while log compression
+and db writes are done in background without blocking the network.
+"""
+import asyncio
+import gzip
+import ssl
+import time
+from urllib.parse import urlsplit
+
+from download_logs_content import DownloadLogContent, is_log_content, response_status
+from http_session import TENHOU_URL, USER_AGENT
+
+
+class AsyncHttpClient(object):
+    """
+    Minimal HTTP/1.1 client on top of asyncio streams.
+    It keeps one keep-alive connection to the host and reconnects when it was closed
+    """
+
+    def __init__(self, base_url, timeout):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.is_https = url.scheme == "https"
+        default_port = self.is_https and 443 or 80
+        self.port = url.port or default_port
+        # like in requests, Host has the port only when it isn't the default one for the scheme
+        host = ":" in self.host and f"[{self.host}]" or self.host
+        self.host_header = self.port == default_port and host or f"{host}:{self.port}"
+        self.timeout = timeout
+
+        self.reader = None
+        self.writer = None
+
+    async def get(self, path):
+        """
+        :return: response status and body
+        """
+        for attempt in range(2):
+            is_reused_connection = self.writer is not None
+            if not is_reused_connection:
+                await self.connect()
+
+            try:
+                return await asyncio.wait_for(self.request(path), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await self.close()
+                # server could close keep-alive connection between our requests
+                if not is_reused_connection or attempt:
+                    raise
+            except Exception:
+                await self.close()
+                raise
+
+    async def connect(self):
+        ssl_context = self.is_https and ssl.create_default_context() or None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ssl_context), self.timeout
+        )
+
+    async def close(self):
+        if self.writer is None:
+            return
+
+        writer = self.writer
+        self.reader = None
+        self.writer = None
+
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    async def request(self, path):
+        self.writer.write(
+            (
+                f"GET {path} HTTP/1.1\r\n"
+                f"Host: {self.host_header}\r\n"
+                f"User-Agent: {USER_AGENT}\r\n"
+                "Accept-Encoding: gzip\r\n"
+                "Connection: keep-alive\r\n"
+                "\r\n"
+            ).encode("latin-1")
+        )
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection was closed by the server")
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self.read_chunked_body()
+        elif "content-length" in headers:
+            body = await self.reader.readexactly(int(headers["content-length"]))
+        else:
+            # body ends with the connection
+            body = await self.reader.read()
+            keep_alive = False
+
+        if not keep_alive:
+            await self.close()
+
+        if headers.get("content-encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+
+        return status, body
+
+    async def read_chunked_body(self):
+        chunks = []
+        while True:
+            size_line = await self.reader.readline()
+            size = int(size_line.split(b";")[0].strip(), 16)
+            if size == 0:
+                # skip trailers
+                while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)
+
+        return b"".join(chunks)
+
+
+class Pacer(object):
+    """
+    Gives out request slots at exact intervals for all connections together
+    """
+
+    def __init__(self, rate_limiter):
+        """
+        :param rate_limiter: RateLimiter or AdaptiveRateLimiter, its current rate sets the interval,
+        0 rate disables pacing
+        """
+        self.rate_limiter = rate_limiter
+        self.next_slot = None
+
+    async def wait(self):
+        rate = self.rate_limiter.rate
+        if not rate:
+            return
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self.next_slot is None or self.next_slot < now:
+            self.next_slot = now
+
+        slot = self.next_slot
+        self.next_slot += 1 / rate
+        await asyncio.sleep(slot - now)
+
+
+class AsyncDownloadLogContent(DownloadLogContent):
+    """
+    The same as DownloadLogContent, but each of threads is a keep-alive connection
+    served by one event loop. Compression runs in the executor and db writes
+    in DatabaseWriter thread, so they overlap with the network waits
+    """
+
+    def download_all_logs(self, results):
+        try:
+            asyncio.run(self.download_all_logs_async(results))
+        except KeyboardInterrupt:
+            print("Stopping... Already downloaded logs will be stored")
+
+    async def download_all_logs_async(self, results):
+        logs_queue = asyncio.Queue()
+        for log_id in results:
+            logs_queue.put_nowait(log_id)
+
+        pacer = Pacer(self.rate_limiter)
+        # compression tasks, we wait for them before the exit
+        pending_stores = set()
+
+        clients = [AsyncHttpClient(TENHOU_URL, self.timeout) for _ in range(self.threads)]
+        try:
+            await asyncio.gather(
+                *[self.download_logs_async(client, logs_queue, pacer, pending_stores) for client in clients]
+            )
+        finally:
+            if pending_stores:
+                await asyncio.wait(pending_stores)
+            for client in clients:
+                await client.close()
+
+    async def download_logs_async(self, client, logs_queue, pacer, pending_stores):
+        loop = asyncio.get_running_loop()
+        while not logs_queue.empty() and not self.stop_event.is_set():
+            log_id = logs_queue.get_nowait()
+            print("Process {}".format(log_id))
+
+            await pacer.wait()
+            binary_content, was_error = await self.request_log_content_async(client, log_id)
+
+            for attempt in range(self.retries):
+                if not was_error:
+                    break
+
+                delay = min(self.retry_delay * 2**attempt, self.max_retry_delay)
+                print(f"Retry {log_id} in {delay} seconds")
+                await asyncio.sleep(delay)
+                # the log stays in the queue of the db
+                if self.stop_event.is_set():
+                    return
+
+                await pacer.wait()
+                binary_content, was_error = await self.request_log_content_async(client, log_id)
+
+            # pass log to the compression stage in the executor and go to the next request,
+            # but wait when the stage is behind, so its bounded queue slows down the downloads
+            while len(pending_stores) >= self.threads * 2:
+                await asyncio.wait(pending_stores, return_when=asyncio.FIRST_COMPLETED)
+
+            future = loop.run_in_executor(None, self.store_log_content, log_id, binary_content, was_error)
+            pending_stores.add(future)
+            future.add_done_callback(pending_stores.discard)
+
+    async def request_log_content_async(self, client, log_id):
+        start_time = time.monotonic()
+        binary_content = None
+        was_error = False
+        try:
+            status_code, binary_content = await client.get(f"/0/log/?{log_id}")
+            if not is_log_content(status_code, binary_content):
+                print("There is no log content in response")
+                was_error = True
+                self.stats.metrics.inc("errors", labels={"error_class": f"no_log_content_{status_code}"})
+            status = response_status(status_code, was_error)
+        except Exception as e:
+            print(repr(e))
+            was_error = True
+            self.stats.metrics.inc("errors", labels={"error_class": e.__class__.__name__})
+            status = "failed"
+
+        self.stats.add("fetch", time.monotonic() - start_time)
+        self.update_rate(start_time, status)
+        self.stats.metrics.inc("fetched_bytes", binary_content and len(binary_content) or 0)
+        return binary_content, was_error
@@ -1,10 +1,16 @@
+import hashlib
 import json
 import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from optparse import OptionParser
 
-import requests
-
+from database import migrate_database
 from download_game_ids import DownloadGameId
+from download_logs_content import RateLimiter
+from http_session import TENHOU_URL, create_session
 
 current_directory = os.path.dirname(os.path.realpath(__file__))
 db_folder = os.path.join(current_directory, "db")
@@ -17,8 +23,23 @@ def main():
     parser = OptionParser()
     parser.add_option("-y", "--year", type="string")
     parser.add_option("-m", "--month", type="string")
+    parser.add_option(
+        "--from", type="string", dest="from_month", help="The first month of the range, e.g. 2006-10"
+    )
+    parser.add_option(
+        "--to", type="string", dest="to_month", help="The last month of the range, e.g. 2024-12"
+    )
+    parser.add_option("-p", "--db_path", type="string", help="Db for all months of the range")
+    parser.add_option("-t", "--threads", type="int", default=3, help="Count of threads")
+    parser.add_option("-r", "--rate", type="float", default=1.0, help="Requests per second for all threads")
     opts, _ = parser.parse_args()
 
+    if opts.from_month:
+        db_file = opts.db_path or os.path.join(db_folder, "yakuman.db")
+        months = month_range(opts.from_month, opts.to_month or datetime.now().strftime("%Y-%m"))
+        download_ids_for_months(db_file, months, opts.threads, opts.rate)
+        return
+
     if len(opts.month) != 2:
         print("Month should be 2 digits")
         return
@@ -41,15 +62,94 @@ def main():
 
 
 def download_ids_for_date(downloader, year: str, month: str):
-    url = f"https://tenhou.net/sc/{year}/{month}/ykm.js"
+    results, _, _ = load_month(downloader, year, month)
+    inserted, _ = downloader.add_logs_to_database(results)
+    print(f"Added {inserted} logs")
+
+
+def download_ids_for_months(db_file, months, threads, rate):
+    """
+    Download yakuman log ids for all months to one db.
+    Months are loaded by the thread pool, they are stored in downloaded_files table,
+    so the next run skips them. The current month is not finished yet and it is loaded each time
+    :param months: list of (year, month)
+    """
+    start_time = datetime.now()
+
+    downloader = DownloadGameId(None, db_file, None, None, False)
+    downloader.session = create_session(pool_size=threads)
+    if not os.path.exists(db_file):
+        downloader.set_up_database()
+    migrate_database(db_file)
+
+    connection = sqlite3.connect(db_file)
+    with connection:
+        cursor = connection.cursor()
+        cursor.execute("CREATE INDEX IF NOT EXISTS logs_month ON logs(substr(date, 1, 7));")
+        cursor.execute("SELECT name FROM downloaded_files;")
+        downloaded_months = set([x[0] for x in cursor.fetchall()])
+    connection.close()
+
+    current_month = datetime.now().strftime("%Y-%m")
+    months = [
+        (year, month)
+        for year, month in months
+        if f"{year}-{month}" == current_month or month_file_name(year, month) not in downloaded_months
+    ]
+    print(f"{len(months)} months to download")
+
+    rate_limiter = RateLimiter(rate)
+    stop_event = threading.Event()
+
+    def load(year, month):
+        if not rate_limiter.acquire(stop_event):
+            return None
+        return load_month(downloader, year, month)
+
+    total_inserted = 0
+    with ThreadPoolExecutor(threads) as executor:
+        futures = {executor.submit(load, year, month): (year, month) for year, month in months}
+        try:
+            # sqlite has one writer, so months are stored from this thread
+            for future in as_completed(futures):
+                year, month = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Failed {year}-{month}: {repr(e)}")
+                    continue
+
+                if result is None:
+                    continue
+
+                results, size, checksum = result
+                inserted, _ = downloader.add_logs_to_database(results)
+                downloader.save_downloaded_files(
+                    [(month_file_name(year, month), size, checksum, len(results))]
+                )
+                total_inserted += inserted
+        except KeyboardInterrupt:
+            print("Stopping... Already downloaded months are stored")
+            stop_event.set()
+
+    print(f"Added {total_inserted} logs")
+    print("Worked time: {} seconds".format((datetime.now() - start_time).seconds))
+
+
+def load_month(downloader, year: str, month: str):
+    """
+    :return: list of (log_id, game_date, is_tonpusen, is_sanma), size and checksum of ykm.js
+    """
+    url = f"{TENHOU_URL}/sc/{year}/{month}/ykm.js"
     print(url)
 
-    response = requests.get(
-        url,
-        headers={
-            "User-Agent": "Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:47.0) Gecko/20100101 Firefox/47.0"
-        },
-    ).content.decode("utf-8")
+    http_response = downloader.session.get(url)
+    http_response.raise_for_status()
+    content = http_response.content
+    response = content.decode("utf-8")
+    # error page or empty response, the month shouldn't be marked as downloaded
+    if "ykm=" not in response:
+        raise ValueError(f"There is no ykm array in {url}")
 
     if "ykm=['" in response:
         data = parse_new_format(response)
@@ -57,24 +157,40 @@ def download_ids_for_date(downloader, year: str, month: str):
         data = parse_old_format(response)
 
     results = []
-    added_log_ids = []
+    added_log_ids = set()
     for x in data:
         date = format_date(year, month, x[0])
         log_id = clean_up_log_id(x[1])
 
         if log_id not in added_log_ids:
-            added_log_ids.append(log_id)
-            results.append(
-                {
-                    "log_id": log_id,
-                    "game_date": date,
-                    "is_tonpusen": 0,
-                    "is_sanma": 0,
-                }
-            )
-
-    downloader.add_logs_to_database(results)
-    print(f"Added {len(results)} logs")
+            added_log_ids.add(log_id)
+            # log_id, game_date, is_tonpusen, is_sanma
+            results.append((log_id, date, 0, 0))
+
+    return results, len(content), hashlib.sha1(content).hexdigest()
+
+
+def month_range(from_month, to_month):
+    """
+    :param from_month: 2006-10
+    :param to_month: 2024-12, it is included to the range
+    :return: list of (year, month) strings
+    """
+    year, month = [int(x) for x in from_month.split("-")]
+    last_year, last_month = [int(x) for x in to_month.split("-")]
+
+    months = []
+    while (year, month) <= (last_year, last_month):
+        months.append((str(year), f"{month:02d}"))
+        month += 1
+        if month > 12:
+            year += 1
+            month = 1
+    return months
+
+
+def month_file_name(year, month):
+    return f"{year}/{month}/ykm.js"
 
 
 def parse_new_format(data: str):
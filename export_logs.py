@@ -0,0 +1,209 @@
+"""
+Export parsed rounds of the downloaded logs to NumPy arrays,
+so training loaders can memory map them instead of parsing gzip XML each epoch.
+
+Each shard folder contains:
+- log_ids.npy: log id of each game
+- tags.npy: uint8 array with all tags of the shard one after another
+- tag_offsets.npy: start of each tag in tags.npy, plus the end of the last tag
+- round_offsets.npy: index of the first tag of each round in tag_offsets.npy, plus the total count
+- game_offsets.npy: index of the first round of each game in round_offsets.npy, plus the total count
+- events.npy: typed events of all rounds, see log_events.py
+- event_offsets.npy: index of the first event of each round in events.npy, plus the total count
+
+For example tags of the round r are
+tags[tag_offsets[round_offsets[r]]:tag_offsets[round_offsets[r + 1]]]
+and its events are events[event_offsets[r]:event_offsets[r + 1]]
+
+index.json in the output folder describes all shards.
+It requires numpy package: pip install numpy
+"""
+import json
+import os
+import shutil
+import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from compression import LogCompressor, load_dictionaries
+from database import logs_with_content, migrate_database
+from log_events import EVENT_DTYPE, decode_rounds
+from validate import LogParser
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class ExportRounds(object):
+    db_file = ""
+    output_folder = ""
+    shard_size = 0
+    workers = 0
+
+    def __init__(self, db_file, output_folder, shard_size, workers):
+        """
+        :param output_folder: folder for shards and index.json
+        :param shard_size: count of logs in one shard
+        :param workers: count of export processes
+        """
+        self.db_file = db_file
+        self.output_folder = output_folder
+        self.shard_size = shard_size
+        self.workers = workers
+
+    def process(self):
+        if np is None:
+            print("numpy package is required: pip install numpy")
+            return
+
+        start_time = datetime.now()
+        migrate_database(self.db_file)
+
+        if not os.path.exists(self.output_folder):
+            os.makedirs(self.output_folder)
+
+        shards = []
+        for shard in self.export_shards():
+            shards.append(shard)
+            print(
+                "Shard {}: {} games, {} rounds, {} tags, {} events".format(
+                    shard["name"], shard["games"], shard["rounds"], shard["tags"], shard["events"]
+                )
+            )
+
+        with open(os.path.join(self.output_folder, "index.json"), "w") as f:
+            json.dump({"db_file": self.db_file, "shards": shards}, f, indent=2)
+
+        print("Exported {} games to {}".format(sum([x["games"] for x in shards]), self.output_folder))
+        print("Worked time: {} seconds".format((datetime.now() - start_time).seconds))
+
+    def export_shards(self):
+        """
+        Export shards in the process pool and return their descriptions in order.
+        Each worker reads its logs from the db itself, we send only log id ranges
+        """
+        with ProcessPoolExecutor(self.workers) as executor:
+            futures = deque()
+            for shard_number, first_log_id, last_log_id in self.load_shard_ranges():
+                shard_folder = os.path.join(self.output_folder, f"{shard_number:05d}")
+                futures.append(
+                    executor.submit(export_shard, self.db_file, shard_folder, first_log_id, last_log_id)
+                )
+                if len(futures) > self.workers * 2:
+                    yield futures.popleft().result()
+
+            while futures:
+                yield futures.popleft().result()
+
+    def load_shard_ranges(self):
+        connection = sqlite3.connect(self.db_file)
+
+        shard_number = 0
+        last_log_id = ""
+        while True:
+            with connection:
+                cursor = connection.cursor()
+                cursor.execute(
+                    "SELECT log_id FROM logs where is_processed = 1 and log_id > ? ORDER BY log_id LIMIT ?;",
+                    [last_log_id, self.shard_size],
+                )
+                log_ids = [x[0] for x in cursor.fetchall()]
+
+            if not log_ids:
+                break
+
+            yield shard_number, log_ids[0], log_ids[-1]
+
+            shard_number += 1
+            last_log_id = log_ids[-1]
+
+        connection.close()
+
+
+def export_shard(db_file, shard_folder, first_log_id, last_log_id):
+    connection = sqlite3.connect(db_file)
+
+    with connection:
+        cursor = connection.cursor()
+        compressor = LogCompressor(load_dictionaries(cursor))
+        cursor.execute(
+            f"SELECT log_id, log_content, content_codec FROM {logs_with_content(cursor)} "
+            "where is_processed = 1 and was_error = 0 and log_id >= ? and log_id <= ? ORDER BY log_id;",
+            [first_log_id, last_log_id],
+        )
+        data = cursor.fetchall()
+
+    connection.close()
+
+    parser = LogParser()
+    log_ids = []
+    tags = []
+    round_sizes = []
+    game_sizes = []
+    events = []
+    event_round_sizes = []
+    for log_id, compressed_content, content_codec in data:
+        try:
+            rounds = parser.split_log_bytes_to_game_rounds(
+                compressor.decompress(content_codec, compressed_content)
+            )
+        except Exception:
+            rounds = None
+
+        # wrong logs are found by validate.py, we just skip them
+        if not rounds:
+            continue
+
+        try:
+            game_events, event_offsets = decode_rounds(rounds)
+        except Exception:
+            continue
+
+        log_ids.append(log_id)
+        game_sizes.append(len(rounds))
+        events.append(game_events)
+        event_round_sizes.extend(np.diff(event_offsets))
+        for game_round in rounds:
+            round_sizes.append(len(game_round))
+            tags.extend(game_round)
+
+    arrays = {
+        "log_ids": np.array(log_ids, dtype="S"),
+        "tags": np.frombuffer(b"".join(tags), dtype=np.uint8),
+        "tag_offsets": sizes_to_offsets([len(x) for x in tags]),
+        "round_offsets": sizes_to_offsets(round_sizes),
+        "game_offsets": sizes_to_offsets(game_sizes),
+        "events": np.concatenate(events or [np.zeros(0, dtype=EVENT_DTYPE)]),
+        "event_offsets": sizes_to_offsets(event_round_sizes),
+    }
+
+    # readers should never see half written shard
+    temp_folder = shard_folder + ".tmp"
+    if os.path.exists(temp_folder):
+        shutil.rmtree(temp_folder)
+    os.makedirs(temp_folder)
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_folder, f"{name}.npy"), array)
+
+    if os.path.exists(shard_folder):
+        shutil.rmtree(shard_folder)
+    os.rename(temp_folder, shard_folder)
+
+    return {
+        "name": os.path.basename(shard_folder),
+        "first_log_id": first_log_id,
+        "last_log_id": last_log_id,
+        "games": len(log_ids),
+        "rounds": len(round_sizes),
+        "tags": len(tags),
+        "events": sum([len(x) for x in events]),
+    }
+
+
+def sizes_to_offsets(sizes):
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets
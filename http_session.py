@@ -0,0 +1,55 @@
+"""
+Shared HTTP session for all tenhou.net downloaders.
+Session keeps connections alive between requests,
+so we don't pay for TCP and TLS handshakes for each log.
+"""
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# it can be replaced with a local server that serves the same urls
+TENHOU_URL = os.environ.get("TENHOU_URL", "https://tenhou.net")
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:47.0) Gecko/20100101 Firefox/47.0"
+
+# seconds to connect and to wait for the response
+DEFAULT_TIMEOUT = 60
+
+
+class TimeoutSession(requests.Session):
+    """
+    requests doesn't have a session wide timeout, so we add it to each request
+    """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
+
+
+def create_session(timeout=DEFAULT_TIMEOUT, retries=3, pool_size=1):
+    """
+    :param timeout: seconds to connect and to wait for the response
+    :param retries: how many times to retry connection errors and 429/5xx responses
+    :param pool_size: how many keep-alive connections to keep for one host
+    """
+    session = TimeoutSession(timeout)
+    session.headers.update({"User-Agent": USER_AGENT, "Accept-Encoding": "gzip, deflate"})
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
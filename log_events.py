@@ -0,0 +1,119 @@
+"""
+Decoder of the log tags to fixed width event records.
+Each event is a row of NumPy structured array with EVENT_DTYPE,
+so a year of logs fits in memory and can be processed with vectorized operations.
+
+Fields that don't make sense for the event kind are -1.
+
+INIT: player is oya, tile is dora indicator, value is round number, extra is honba,
+target is count of riichi sticks. It is followed by SCORE event for each player
+(value is score) and HAND event for each tile of the start hands.
+DRAW and DISCARD: player and tile.
+CALL: player, value is the meld code from "m" attribute.
+REACH: player, value is the step (1 or 2).
+DORA: tile is new dora indicator.
+AGARI: player is the winner, target is the player who dealt in (or the winner for tsumo),
+tile is the winning tile, value is the hand cost, extra is fu.
+RYUUKYOKU: value is the draw type from RYUUKYOKU_TYPES.
+
+Other tags (UN, BYE) are skipped.
+It requires numpy package: pip install numpy
+"""
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+INIT = 1
+HAND = 2
+SCORE = 3
+DRAW = 4
+DISCARD = 5
+CALL = 6
+REACH = 7
+DORA = 8
+AGARI = 9
+RYUUKYOKU = 10
+
+RYUUKYOKU_TYPES = {b"": 0, b"yao9": 1, b"reach4": 2, b"ron3": 3, b"kan4": 4, b"kaze4": 5, b"nm": 6}
+
+EVENT_DTYPE = np and np.dtype(
+    [
+        ("kind", np.uint8),
+        ("player", np.int8),
+        ("target", np.int8),
+        ("tile", np.int16),
+        ("value", np.int32),
+        ("extra", np.int32),
+    ]
+)
+
+DRAW_TAGS = {b"T": 0, b"U": 1, b"V": 2, b"W": 3}
+DISCARD_TAGS = {b"D": 0, b"E": 1, b"F": 2, b"G": 3}
+
+tag_regex = re.compile(rb"<([A-Z]+)(\d*)([^>]*)>")
+attribute_regex = re.compile(rb'(\w+)="([^"]*)"')
+
+
+def decode_rounds(rounds):
+    """
+    :param rounds: rounds of one game from LogParser.split_log_bytes_to_game_rounds
+    :return: events array and offsets of the first event of each round plus the total count
+    """
+    events = []
+    round_offsets = [0]
+    for game_round in rounds:
+        for tag in game_round:
+            decode_tag(tag, events)
+        round_offsets.append(len(events))
+
+    return np.array(events, dtype=EVENT_DTYPE), np.array(round_offsets, dtype=np.int64)
+
+
+def decode_tag(tag, events):
+    """
+    Add events of the tag to the events list
+    """
+    match = tag_regex.search(tag)
+    if not match:
+        return
+
+    name, number, attributes = match.groups()
+
+    # draws and discards are the most of tags, so they go first
+    if number:
+        if name in DRAW_TAGS:
+            events.append((DRAW, DRAW_TAGS[name], -1, int(number), -1, -1))
+        elif name in DISCARD_TAGS:
+            events.append((DISCARD, DISCARD_TAGS[name], -1, int(number), -1, -1))
+        return
+
+    attributes = dict(attribute_regex.findall(attributes))
+    if name == b"N":
+        events.append((CALL, int(attributes[b"who"]), -1, -1, int(attributes[b"m"]), -1))
+    elif name == b"REACH":
+        events.append((REACH, int(attributes[b"who"]), -1, -1, int(attributes[b"step"]), -1))
+    elif name == b"DORA":
+        events.append((DORA, -1, -1, int(attributes[b"hai"]), -1, -1))
+    elif name == b"INIT":
+        round_number, honba, riichi_sticks, _, _, dora_indicator = [
+            int(x) for x in attributes[b"seed"].split(b",")
+        ]
+        events.append((INIT, int(attributes[b"oya"]), riichi_sticks, dora_indicator, round_number, honba))
+        for player, score in enumerate(attributes[b"ten"].split(b",")):
+            events.append((SCORE, player, -1, -1, int(score), -1))
+        for player in range(4):
+            hand = attributes.get(b"hai%d" % player)
+            if hand:
+                for tile in hand.split(b","):
+                    events.append((HAND, player, -1, int(tile), -1, -1))
+    elif name == b"AGARI":
+        fu, cost = [int(x) for x in attributes[b"ten"].split(b",")[:2]]
+        events.append(
+            (AGARI, int(attributes[b"who"]), int(attributes[b"fromWho"]), int(attributes[b"machi"]), cost, fu)
+        )
+    elif name == b"RYUUKYOKU":
+        draw_type = RYUUKYOKU_TYPES.get(attributes.get(b"type", b""), 0)
+        events.append((RYUUKYOKU, -1, -1, -1, draw_type, -1))
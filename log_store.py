@@ -0,0 +1,198 @@
+"""
+Read-only access to the downloaded logs for analysis and training code.
+
+LogStore finds logs by id or iterates them by date range with sanma and tonpusen filters,
+decompressed logs and parsed rounds are kept in the LRU cache limited by size in bytes.
+Each thread reads the db with its own read-only connection, so one store can be
+shared by the threads of a data loader.
+
+Example:
+    store = LogStore("db/2009.db")
+    rounds = store.get_rounds("2009022011gm-00a9-0000-d7935c6d")
+    for log_id, date, log_content in store.iterate_logs(from_date="2009-02-01", to_date="2009-03-01"):
+        ...
+"""
+import pathlib
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+from compression import GZIP_CODEC, LogCompressor, load_dictionaries
+from database import has_content_codec, logs_with_content
+from validate import LogParser
+
+DEFAULT_CACHE_SIZE = 256 * 2**20
+
+
+class LogCache(object):
+    """
+    Thread safe LRU cache, the least recently used items are removed
+    when the total size of the items is bigger than max_size bytes
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, size):
+        # too big item would remove everything else from the cache
+        if size > self.max_size:
+            return
+
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, removed_size) = self.items.popitem(last=False)
+                self.size -= removed_size
+
+
+class LogStore(object):
+    def __init__(self, db_file, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        :param cache_size: size of the decompressed logs and parsed rounds cache in bytes, 0 to disable it
+        """
+        self.db_file = db_file
+        self.cache = LogCache(cache_size)
+        self.parser = LogParser()
+
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+        # the store doesn't migrate the db, it can be written by the downloader or be on read-only storage,
+        # so it reads both layouts and dbs without the codec column
+        self.uri = pathlib.Path(db_file).resolve().as_uri() + "?mode=ro"
+
+        cursor = self._connection().cursor()
+        self.table = logs_with_content(cursor)
+        if has_content_codec(cursor):
+            self.codec_column = "content_codec"
+            self.compressor = LogCompressor(load_dictionaries(cursor))
+        else:
+            self.codec_column = f"{GZIP_CODEC} AS content_codec"
+            self.compressor = LogCompressor()
+
+    def get_log(self, log_id):
+        """
+        :return: decompressed log content or None if the log wasn't downloaded
+        """
+        log_content = self.cache.get(log_id)
+        if log_content is not None:
+            return log_content
+
+        cursor = self._connection().cursor()
+        cursor.execute(
+            f"SELECT log_content, {self.codec_column} FROM {self.table} "
+            "where log_id = ? and is_processed = 1 and was_error = 0;",
+            [log_id],
+        )
+        row = cursor.fetchone()
+        if not row or not row[0]:
+            return None
+
+        log_content = self._decompress(row[1], row[0])
+        self.cache.put(log_id, log_content, sys.getsizeof(log_content))
+        return log_content
+
+    def get_rounds(self, log_id):
+        """
+        :return: rounds of the log from LogParser.split_log_bytes_to_game_rounds or None
+        """
+        key = ("rounds", log_id)
+        rounds = self.cache.get(key)
+        if rounds is not None:
+            return rounds
+
+        log_content = self.get_log(log_id)
+        if log_content is None:
+            return None
+
+        rounds = self.parser.split_log_bytes_to_game_rounds(log_content)
+        size = sum([sys.getsizeof(tag) for game_round in rounds for tag in game_round])
+        self.cache.put(key, rounds, size)
+        return rounds
+
+    def iterate_logs(self, from_date=None, to_date=None, is_sanma=None, is_tonpusen=None, batch_size=500):
+        """
+        Iterate downloaded logs in the order of their dates.
+        Logs are read by pages with the date index and they don't go to the cache
+        :param from_date: the first date, e.g. 2009-02-01
+        :param to_date: the date after the last one, e.g. 2009-03-01
+        :param is_sanma: True or False to filter logs, None for all logs
+        :param is_tonpusen: True or False to filter logs, None for all logs
+        :return: generator of (log_id, date, log_content) tuples
+        """
+        conditions = ["is_processed = 1", "was_error = 0", "(date, log_id) > (?, ?)"]
+        parameters = []
+        if to_date is not None:
+            conditions.append("date < ?")
+            parameters.append(to_date)
+        if is_sanma is not None:
+            conditions.append("is_sanma = ?")
+            parameters.append(is_sanma and 1 or 0)
+        if is_tonpusen is not None:
+            conditions.append("is_tonpusen = ?")
+            parameters.append(is_tonpusen and 1 or 0)
+
+        query = (
+            f"SELECT log_id, date, log_content, {self.codec_column} FROM {self.table} "
+            f"where {' and '.join(conditions)} ORDER BY date, log_id LIMIT ?;"
+        )
+
+        last_date = from_date or ""
+        last_log_id = ""
+        while True:
+            cursor = self._connection().cursor()
+            cursor.execute(query, [last_date, last_log_id] + parameters + [batch_size])
+            batch = cursor.fetchall()
+            if not batch:
+                break
+
+            last_log_id, last_date = batch[-1][0], batch[-1][1]
+            for log_id, date, log_content, content_codec in batch:
+                yield log_id, date, self._decompress(content_codec, log_content)
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # connection is used only by its thread, but close() can be called from any thread
+            connection = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+
+        return connection
+
+    def _decompress(self, codec, log_content):
+        # dictionary could be trained after the store was opened
+        if codec and codec not in self.compressor.dictionaries:
+            self.compressor = LogCompressor(load_dictionaries(self._connection().cursor()))
+
+        return self.compressor.decompress(codec, log_content)
@@ -3,12 +3,16 @@ from datetime import datetime
 from distutils.dir_util import mkpath
 from optparse import OptionParser
 
-from download_game_ids import DownloadGameId
+from download_game_ids import DownloadGameId, parse_years, process_year_archives
 from download_logs_content import DownloadLogContent
+from download_logs_content_async import AsyncDownloadLogContent
+from export_logs import ExportRounds
+from metrics import run_with_profile
 
 current_directory = os.path.dirname(os.path.realpath(__file__))
 logs_directory = os.path.join(current_directory, "temp")
 db_folder = os.path.join(current_directory, "db")
+export_folder = os.path.join(current_directory, "export")
 
 current_year = str(datetime.now().year)
 
@@ -25,10 +29,35 @@ def parse_command_line_arguments():
     parser = OptionParser()
 
     parser.add_option("-y", "--year", type="string", default=None, help="Target year to download logs")
+    parser.add_option(
+        "--years", type="string", default=None, help="Years to add ids from archives, e.g. 2009-2024"
+    )
     parser.add_option("-p", "--db_path", type="string")
-    parser.add_option("-a", "--action", type="string", default="id", help="id or content")
+    parser.add_option("-a", "--action", type="string", default="id", help="id, content or export")
     parser.add_option("-l", "--limit", type="int", default=0, help="To download content script")
     parser.add_option("-t", "--threads", type="int", default=3, help="Count of threads")
+    parser.add_option(
+        "-r", "--rate", type="float", default=1.0, help="Requests per second for all threads, 0 for no limit"
+    )
+    parser.add_option(
+        "--adaptive", action="store_true", default=False, help="Adjust the rate to throttling and error pages"
+    )
+    parser.add_option("--max_rate", type="float", default=10, help="The highest rate for --adaptive")
+    parser.add_option(
+        "--worker_id", type="string", help="Name of this process in claims of logs, host and pid by default"
+    )
+    parser.add_option(
+        "--lease", type="int", default=600, help="Seconds before claims of a killed download expire"
+    )
+    parser.add_option("--retries", type="int", default=3, help="How many times to retry failed log download")
+    parser.add_option("--engine", type="string", default="thread", help="thread or async content download")
+    parser.add_option("--codec", type="string", default="gzip", help="gzip or zstd to compress logs")
+    parser.add_option("--timeout", type="float", default=60, help="Seconds to wait for tenhou.net response")
+    parser.add_option(
+        "--catalog", type="string", help="Catalog db to copy logs that were already downloaded to other dbs"
+    )
+    parser.add_option("--commit_size", type="int", default=100, help="Count of logs stored in one commit")
+    parser.add_option("--commit_interval", type="float", default=5, help="Max seconds between commits")
     parser.add_option(
         "-f", "--from_archive", action="store_true", dest="from_archive", help="Extract logs from archive"
     )
@@ -36,6 +65,22 @@ def parse_command_line_arguments():
         "-s", action="store_true", dest="start", help="Download log ids from the start of the year"
     )
     parser.add_option("--strip", action="store_true", default=False, help="Strip some tags from logs")
+    parser.add_option("-o", "--output", type="string", help="Folder for exported rounds")
+    parser.add_option(
+        "-w", "--workers", type="int", default=1, help="Count of processes for --years and export actions"
+    )
+    parser.add_option(
+        "--compress_workers",
+        type="int",
+        default=0,
+        help="Count of processes to compress downloaded logs, 0 to compress them in download threads",
+    )
+    parser.add_option("--shard_size", type="int", default=10000, help="Count of logs in one exported shard")
+    parser.add_option("--metrics", type="string", help="JSON lines file for content download metrics")
+    parser.add_option("--prometheus", type="string", help="Prometheus textfile for content download metrics")
+    parser.add_option(
+        "--profile", action="store_true", default=False, help="Profile the run with cProfile and tracemalloc"
+    )
 
     opts, _ = parser.parse_args()
     return opts
@@ -46,15 +91,51 @@ def main():
 
     opts = parse_command_line_arguments()
 
+    if opts.profile:
+        run_with_profile(lambda: run_action(opts), f"profile_{opts.action}.prof")
+    else:
+        run_action(opts)
+
+
+def run_action(opts):
     if opts.db_path:
         db_file = opts.db_path
     else:
         db_file = os.path.join(db_folder, f"{opts.year}.db")
 
-    if opts.action == "id":
-        DownloadGameId(logs_directory, db_file, opts.year, opts.start, opts.from_archive).process()
+    if opts.action == "id" and opts.years:
+        process_year_archives(logs_directory, db_folder, parse_years(opts.years), opts.workers)
+    elif opts.action == "id":
+        DownloadGameId(
+            logs_directory, db_file, opts.year, opts.start, opts.from_archive, opts.timeout
+        ).process()
     elif opts.action == "content":
-        DownloadLogContent(db_file, opts.limit, opts.threads, opts.strip).process()
+        downloader_class = opts.engine == "async" and AsyncDownloadLogContent or DownloadLogContent
+        downloader_class(
+            db_file,
+            opts.limit,
+            opts.threads,
+            opts.strip,
+            rate=opts.rate,
+            retries=opts.retries,
+            commit_size=opts.commit_size,
+            commit_interval=opts.commit_interval,
+            timeout=opts.timeout,
+            codec=opts.codec,
+            catalog_file=opts.catalog,
+            compress_workers=opts.compress_workers,
+            metrics_file=opts.metrics,
+            prometheus_file=opts.prometheus,
+            adaptive=opts.adaptive,
+            max_rate=opts.max_rate,
+            worker_id=opts.worker_id,
+            lease_time=opts.lease,
+        ).process()
+    elif opts.action == "export":
+        output_folder = opts.output or os.path.join(
+            export_folder, os.path.splitext(os.path.basename(db_file))[0]
+        )
+        ExportRounds(db_file, output_folder, opts.shard_size, opts.workers).process()
     else:
         print("Unknown action")
 
@@ -0,0 +1,216 @@
+"""
+Metrics of the download and validation runs: counters, gauges and latency histograms.
+They can be appended to JSON lines file and written to Prometheus textfile,
+e.g. for node_exporter textfile collector.
+
+run_with_profile wraps a run with cProfile (for all threads of the process)
+and tracemalloc, and prints the report at the end.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# seconds, they cover the fast local operations and the slow network requests
+DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+PROMETHEUS_PREFIX = "tenhou_logs_"
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # count of observations for each bucket, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                index = i
+                break
+
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """
+        :return: list of (upper bound, count of observations less or equal to it)
+        """
+        results = []
+        total = 0
+        for bucket, count in zip(self.buckets + ["+Inf"], self.counts):
+            total += count
+            results.append((bucket, total))
+        return results
+
+
+class Metrics(object):
+    """
+    Thread safe storage of the run metrics.
+    Counters and gauges can have labels, e.g. inc("errors", labels={"error_class": "ReadTimeout"})
+    """
+
+    def __init__(self, run_name):
+        self.run_name = run_name
+        self.start_time = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def counter(self, name):
+        """
+        :return: sum of the counter over all labels
+        """
+        with self.lock:
+            return sum([value for (key, _), value in self.counters.items() if key == name])
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "time": time.time(),
+                "run": self.run_name,
+                "elapsed": self.elapsed(),
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.gauges.items()
+                ],
+                "histograms": {
+                    name: {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": [[str(bucket), count] for bucket, count in histogram.cumulative_counts()],
+                    }
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for metric_type, values in [("counter", self.counters), ("gauge", self.gauges)]:
+                names = sorted(set([name for name, _ in values]))
+                for name in names:
+                    full_name = PROMETHEUS_PREFIX + name
+                    if metric_type == "counter":
+                        full_name += "_total"
+                    lines.append(f"# TYPE {full_name} {metric_type}")
+                    for (key, labels), value in sorted(values.items()):
+                        if key == name:
+                            labels = dict(labels, run=self.run_name)
+                            lines.append(f"{full_name}{format_labels(labels)} {value}")
+
+            for name, histogram in sorted(self.histograms.items()):
+                full_name = PROMETHEUS_PREFIX + name
+                lines.append(f"# TYPE {full_name} histogram")
+                for bucket, count in histogram.cumulative_counts():
+                    labels = format_labels({"run": self.run_name, "le": bucket})
+                    lines.append(f"{full_name}_bucket{labels} {count}")
+                labels = format_labels({"run": self.run_name})
+                lines.append(f"{full_name}_sum{labels} {histogram.sum}")
+                lines.append(f"{full_name}_count{labels} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    return "{" + ",".join([f'{key}="{value}"' for key, value in sorted(labels.items())]) + "}"
+
+
+class MetricsWriter(object):
+    def __init__(self, metrics, json_file=None, prometheus_file=None):
+        """
+        :param json_file: each write appends one line with all metrics to it
+        :param prometheus_file: each write replaces it with the current metrics
+        """
+        self.metrics = metrics
+        self.json_file = json_file
+        self.prometheus_file = prometheus_file
+
+    def write(self):
+        if self.json_file:
+            with open(self.json_file, "a") as f:
+                f.write(json.dumps(self.metrics.to_dict()) + "\n")
+
+        if self.prometheus_file:
+            # textfile collector shouldn't read half written file
+            temp_file = self.prometheus_file + ".tmp"
+            with open(temp_file, "w") as f:
+                f.write(self.metrics.to_prometheus())
+            os.replace(temp_file, self.prometheus_file)
+
+
+def run_with_profile(function, profile_file, top=30):
+    """
+    Run the function with cProfile and tracemalloc.
+    Threads started by the function are profiled too, worker processes are not.
+    :param profile_file: file for pstats dump, it can be opened with snakeviz or pstats
+    """
+    profiles = []
+
+    def profile_thread(*args):
+        sys.setprofile(None)
+        thread_profile = cProfile.Profile()
+        profiles.append(thread_profile)
+        thread_profile.enable()
+
+    tracemalloc.start()
+    threading.setprofile(profile_thread)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        return function()
+    finally:
+        profile.disable()
+        threading.setprofile(None)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        stats = pstats.Stats(profile)
+        for thread_profile in profiles:
+            thread_profile.create_stats()
+            stats.add(thread_profile)
+        stats.dump_stats(profile_file)
+
+        output = io.StringIO()
+        pstats.Stats(profile_file, stream=output).sort_stats("cumulative").print_stats(top)
+        print(output.getvalue())
+
+        print(f"Peak traced memory: {peak_memory / 2**20:.1f} MB")
+        print("Top allocations:")
+        for stat in snapshot.statistics("lineno")[:10]:
+            print(stat)
+        print(f"Profile was saved to {profile_file}")
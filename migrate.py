@@ -0,0 +1,72 @@
+"""
+Script to move compressed logs of the old db from logs.log_content column
+to the separate logs_content table, the same layout new dbs have
+"""
+import os
+import sqlite3
+from datetime import datetime
+from optparse import OptionParser
+
+from database import has_content_table, migrate_database
+
+db_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "db")
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-y", "--year", type="string", default=str(datetime.now().year), help="Target year")
+    parser.add_option("-p", "--db_path", type="string")
+    opts, _ = parser.parse_args()
+
+    if opts.db_path:
+        db_file = opts.db_path
+    else:
+        db_file = os.path.join(db_folder, f"{opts.year}.db")
+
+    move_log_content_to_separate_table(db_file)
+
+
+def move_log_content_to_separate_table(db_file):
+    # DROP COLUMN appeared in 3.35.0
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        print(f"SQLite 3.35.0 or newer is required, current version is {sqlite3.sqlite_version}")
+        return
+
+    migrate_database(db_file)
+    connection = sqlite3.connect(db_file)
+
+    with connection:
+        cursor = connection.cursor()
+        if has_content_table(cursor):
+            print("Logs content is already stored in the separate table")
+            return
+
+        print("Moving logs content...")
+        cursor.execute(
+            """
+            CREATE TABLE logs_content(
+                log_id text primary key,
+                log_content blob,
+                content_codec int default 0
+            );
+            """
+        )
+        cursor.execute(
+            "INSERT INTO logs_content (log_id, log_content, content_codec) "
+            "SELECT log_id, log_content, content_codec FROM logs where is_processed = 1 and was_error = 0;"
+        )
+        moved_logs = cursor.rowcount
+        cursor.execute("ALTER TABLE logs DROP COLUMN log_content;")
+        cursor.execute("ALTER TABLE logs DROP COLUMN content_codec;")
+
+    print(f"Moved {moved_logs} logs")
+
+    # return the space of the dropped column
+    print("Compacting database...")
+    connection.execute("VACUUM;")
+    connection.close()
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Local stand-in of tenhou.net for benchmarks with synthetic data.
+It serves the same urls the downloaders use:
+- /sc/raw/list.cgi with the list of scc files (ETag is supported)
+- /sc/raw/dat/<file> with scc files of the synthetic games
+- /0/log/?<log_id> with the generated mjlog of the game
+- /sc/<year>/<month>/ykm.js with the yakuman games of the month
+
+Logs are generated from the log id, so the same id always has the same content.
+Run it and point the downloaders to it with TENHOU_URL environment variable:
+python tenhou_stand_in.py --port 8000 --latency 0.05
+TENHOU_URL=http://127.0.0.1:8000 python main.py -a content -p db/bench.db -l 100
+"""
+import gzip
+import hashlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+
+GAME_TYPES = ["四鳳南喰赤－", "四鳳東喰赤－", "三鳳南喰赤－", "三鳳東喰赤－"]
+
+
+class Corpus(object):
+    """
+    Synthetic scc files and yakuman lists of one year
+    """
+
+    def __init__(self, year=2020, days=7, games_per_file=100, yakuman_months=12, seed=0):
+        """
+        :param days: count of scc files, one for each day
+        :param games_per_file: count of games in each scc file
+        :param yakuman_months: count of months with ykm.js from january
+        """
+        self.year = year
+        self.scc_files = {}
+        self.yakuman_files = {}
+        self.log_ids = []
+
+        rng = random.Random(seed)
+        for day in range(days):
+            date = f"{year}{1 + day // 28:02d}{1 + day % 28:02d}"
+            lines = []
+            for _ in range(games_per_file):
+                hour = rng.randrange(24)
+                log_id = f"{date}{hour:02d}gm-00a9-0000-{rng.randrange(1 << 32):08x}"
+                self.log_ids.append(log_id)
+                lines.append(
+                    f"{hour:02d}:{rng.randrange(60):02d} | {rng.randrange(10, 60)} | {rng.choice(GAME_TYPES)} | "
+                    f'<a href="http://tenhou.net/0/?log={log_id}">牌譜</a> | '
+                    "A(+50.0) B(+10.0) C(-20.0) D(-40.0)<br>\r\n"
+                )
+            self.scc_files[f"scc{date}.html.gz"] = gzip.compress("".join(lines).encode())
+
+        for month in range(1, yakuman_months + 1):
+            items = []
+            for day in range(1, 29, 3):
+                log_id = f"{year}{month:02d}{day:02d}12gm-00a9-0000-{rng.randrange(1 << 32):08x}"
+                items.extend([f"{month:02d}/{day:02d} 12:{day:02d}", "A", "B", "39", f"{log_id}&tw=1"])
+            body = "ykm=[" + ",".join([f"'{x}'" for x in items]) + "];"
+            self.yakuman_files[f"{year}/{month:02d}"] = f"// yakuman\r\n//\r\n{body}\r\n".encode()
+
+        files = [f"{{file:'{name}',size:{len(content)}}}" for name, content in sorted(self.scc_files.items())]
+        self.list_content = ("list([\r\n" + ",\r\n".join(files) + "\r\n]);").encode()
+        self.list_etag = '"{}"'.format(hashlib.sha1(self.list_content).hexdigest())
+
+
+def make_log(log_id, rounds=8):
+    """
+    :return: mjlog of the game with draws, discards, calls, riichi, dora, wins and draws
+    """
+    rng = random.Random(log_id)
+    parts = [
+        '<mjloggm ver="2.3">',
+        '<SHUFFLE seed="mt19937ar-sha512-n288-base64,{}" ref=""/>'.format(
+            hashlib.sha1(log_id.encode()).hexdigest()
+        ),
+        '<GO type="169" lobby="0"/>',
+        '<UN n0="%41" n1="%42" n2="%43" n3="%44" dan="16,16,16,16" '
+        'rate="2000.00,2000.00,2000.00,2000.00" sx="M,M,M,M"/>',
+        '<TAIKYOKU oya="0"/>',
+    ]
+    for round_number in range(rounds):
+        tiles = list(range(136))
+        rng.shuffle(tiles)
+        hands = [",".join([str(x) for x in tiles[i * 13 : i * 13 + 13]]) for i in range(4)]
+        parts.append(
+            f'<INIT seed="{round_number},0,0,{rng.randrange(6)},{rng.randrange(6)},{tiles[52]}" '
+            f'ten="250,250,250,250" oya="{round_number % 4}" '
+            f'hai0="{hands[0]}" hai1="{hands[1]}" hai2="{hands[2]}" hai3="{hands[3]}"/>'
+        )
+
+        for turn in range(rng.randrange(40, 70)):
+            player = turn % 4
+            tile = tiles[53 + turn % 80]
+            parts.append(f'<{"TUVW"[player]}{tile}/>')
+            if turn == 17:
+                parts.append(f'<N who="{player}" m="{rng.randrange(1 << 16)}" />')
+            if turn == 25:
+                parts.append(f'<REACH who="{player}" step="1"/>')
+            parts.append(f'<{"DEFG"[player]}{tile}/>')
+            if turn == 25:
+                parts.append(f'<REACH who="{player}" ten="250,240,250,250" step="2"/>')
+            if turn == 33:
+                parts.append(f'<DORA hai="{tiles[133]}" />')
+
+        owari = round_number == rounds - 1 and ' owari="250,0.0,250,0.0,250,0.0,250,0.0"' or ""
+        if rng.random() < 0.8:
+            parts.append(
+                f'<AGARI ba="0,0" hai="{hands[0]}" machi="{tiles[0]}" ten="30,3900,0" yaku="1,1,52,2" '
+                f'doraHai="{tiles[52]}" who="{rng.randrange(4)}" fromWho="{rng.randrange(4)}" '
+                f'sc="250,39,250,-39,250,0,250,0"{owari} />'
+            )
+        else:
+            parts.append(f'<RYUUKYOKU ba="0,0" sc="250,15,250,-15,250,15,250,-15"{owari} />')
+
+    parts.append("</mjloggm>")
+    return "".join(parts).encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        server.count_request()
+        if server.latency:
+            time.sleep(server.latency)
+
+        path = self.path
+        if path.startswith("/sc/raw/list.cgi"):
+            if self.headers.get("If-None-Match") == server.corpus.list_etag:
+                return self.send_body(304, b"")
+            return self.send_body(200, server.corpus.list_content, {"ETag": server.corpus.list_etag})
+
+        if path.startswith("/sc/raw/dat/"):
+            name = path.split("/")[-1]
+            if name not in server.corpus.scc_files:
+                return self.send_body(404, b"not found")
+            return self.send_body(200, server.corpus.scc_files[name])
+
+        if path.startswith("/0/log/?"):
+            error = server.random_error()
+            if error == "server":
+                return self.send_body(503, b"service unavailable")
+            if error == "page":
+                return self.send_body(200, b"<html><body>error</body></html>")
+            return self.send_body(200, make_log(path[len("/0/log/?") :]), compress=True)
+
+        if path.endswith("/ykm.js"):
+            _, _, year, month, _ = path.split("/")
+            content = server.corpus.yakuman_files.get(f"{year}/{month}")
+            if content is None:
+                return self.send_body(404, b"not found")
+            return self.send_body(200, content)
+
+        self.send_body(404, b"not found")
+
+    def send_body(self, status, body, headers=None, compress=False):
+        headers = headers or {}
+        if compress and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, corpus, latency=0, error_rate=0, port=0):
+        """
+        :param latency: seconds to wait before each response
+        :param error_rate: part of log requests that fail with 503 or with an error page
+        :param port: 0 to use any free port
+        """
+        super().__init__(("127.0.0.1", port), StandInHandler)
+        self.corpus = corpus
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def random_error(self):
+        with self.lock:
+            value = self.random.random()
+
+        if value >= self.error_rate:
+            return None
+        return value < self.error_rate / 2 and "server" or "page"
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--port", type="int", default=8000)
+    parser.add_option("-y", "--year", type="int", default=2020, help="Year of the synthetic games")
+    parser.add_option("--days", type="int", default=7, help="Count of scc files")
+    parser.add_option("--games", type="int", default=100, help="Count of games in one scc file")
+    parser.add_option("--latency", type="float", default=0, help="Seconds before each response")
+    parser.add_option("--error_rate", type="float", default=0, help="Part of failed log requests")
+    opts, _ = parser.parse_args()
+
+    server = StandInServer(Corpus(opts.year, opts.days, opts.games), opts.latency, opts.error_rate, opts.port)
+    print(f"Serving {opts.days * opts.games} games on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
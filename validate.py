@@ -1,13 +1,19 @@
-import gzip
 import os
 import re
 import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from optparse import OptionParser
 from typing import List
 
 from tqdm import tqdm
 
+from compression import LogCompressor, load_dictionaries
+from database import add_logs_to_download_queue, logs_with_content, migrate_database
+from metrics import Metrics, MetricsWriter, run_with_profile
+
 db_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "db")
 
 
@@ -15,6 +21,16 @@ def main():
     parser = OptionParser()
     parser.add_option("-y", "--year", type="string", default=str(datetime.now().year), help="Target year")
     parser.add_option("-p", "--db_path", type="string")
+    parser.add_option("-w", "--workers", type="int", default=1, help="Count of validation processes")
+    parser.add_option("-b", "--batch_size", type="int", default=1000, help="Count of logs in one batch")
+    parser.add_option(
+        "-s", action="store_true", dest="start", help="Ignore saved checkpoint and validate all logs"
+    )
+    parser.add_option("--metrics", type="string", help="JSON lines file for validation metrics")
+    parser.add_option("--prometheus", type="string", help="Prometheus textfile for validation metrics")
+    parser.add_option(
+        "--profile", action="store_true", default=False, help="Profile the run with cProfile and tracemalloc"
+    )
     opts, _ = parser.parse_args()
 
     if opts.db_path:
@@ -22,54 +38,264 @@ def main():
     else:
         db_file = os.path.join(db_folder, f"{opts.year}.db")
 
-    connection = sqlite3.connect(db_file)
+    if opts.profile:
+        run_with_profile(lambda: validate(db_file, opts), "profile_validate.prof")
+    else:
+        validate(db_file, opts)
 
-    were_errors = False
+
+def validate(db_file, opts):
+    migrate_database(db_file)
+    connection = sqlite3.connect(db_file)
 
     with connection:
         cursor = connection.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS validation_checkpoint(last_log_id text);")
+
+        last_log_id = ""
+        if not opts.start:
+            cursor.execute("SELECT last_log_id FROM validation_checkpoint;")
+            data = cursor.fetchone()
+            if data:
+                last_log_id = data[0]
+                print(f"Continue validation after {last_log_id}")
 
         cursor.execute("SELECT COUNT(*) from logs;")
         total = cursor.fetchone()[0]
 
-        print("Fetching logs...")
-        cursor.execute("SELECT log_id, log_content FROM logs where is_processed = 1;")
-        data = list(cursor.fetchall())
-
-        parser = LogParser()
-        valid_logs = 0
-
-        print("Decompressing and validating logs...")
-        bar = tqdm(data)
-        for x in bar:
-            was_error = False
-            log_id = x[0]
-            try:
-                log_content = gzip.decompress(x[1]).decode("utf-8")
-                if not log_content:
-                    was_error = True
-
-                if log_content:
-                    parsed_rounds = parser.split_log_to_game_rounds(log_content)
-                    if not parsed_rounds:
-                        was_error = True
-                    else:
-                        valid_logs += 1
-            except Exception:
-                was_error = True
-
-            if was_error:
-                were_errors = True
-                bar.write("Found wrong log content, adding it back to download queue")
-                cursor.execute(
-                    f'UPDATE logs set is_processed = 0, was_error = 0, log_content="" where log_id = "{log_id}"'
-                )
+        dictionaries = load_dictionaries(cursor)
+
+        cursor.execute("SELECT COUNT(*) from logs where is_processed = 1 and log_id > ?;", [last_log_id])
+        processed = cursor.fetchone()[0]
+
+    batches = load_processed_logs(connection, opts.batch_size, last_log_id)
+    if opts.workers > 1:
+        results = validate_in_parallel(batches, opts.workers, dictionaries)
+    else:
+        init_validation(dictionaries)
+        results = map(validate_logs, batches)
+
+    valid_logs = 0
+    were_errors = False
+    metrics = Metrics("validate")
+    metrics_writer = MetricsWriter(metrics, opts.metrics, opts.prometheus)
+
+    print("Decompressing and validating logs...")
+    bar = tqdm(total=processed)
+    for checked_logs, batch_valid_logs, wrong_log_ids, last_log_id, batch_metrics in results:
+        valid_logs += batch_valid_logs
+        for _ in wrong_log_ids:
+            were_errors = True
+            bar.write("Found wrong log content, adding it back to download queue")
+
+        # results and checkpoint are stored together,
+        # so interrupted validation can be continued from this batch
+        start_time = time.perf_counter()
+        with connection:
+            cursor = connection.cursor()
+            add_wrong_logs_to_download_queue(cursor, wrong_log_ids)
+            cursor.execute("DELETE FROM validation_checkpoint;")
+            cursor.execute("INSERT INTO validation_checkpoint VALUES (?);", [last_log_id])
+        metrics.observe("commit_seconds", time.perf_counter() - start_time)
+
+        add_batch_metrics(metrics, checked_logs, batch_valid_logs, batch_metrics)
+        metrics_writer.write()
+
+        bar.update(checked_logs)
+    bar.close()
+
+    with connection:
+        connection.execute("DELETE FROM validation_checkpoint;")
 
     if not were_errors:
         print(f"Everything is fine, checked {valid_logs}/{total}")
 
 
+def load_processed_logs(connection, batch_size, last_log_id):
+    """
+    Load logs page by page ordered by log_id,
+    so only one batch is kept in memory at once
+    """
+    while True:
+        cursor = connection.cursor()
+        cursor.execute(
+            f"SELECT log_id, log_content, content_codec FROM {logs_with_content(cursor)} "
+            "where is_processed = 1 and log_id > ? ORDER BY log_id LIMIT ?;",
+            [last_log_id, batch_size],
+        )
+        batch = cursor.fetchall()
+        if not batch:
+            break
+
+        last_log_id = batch[-1][0]
+        yield batch
+
+
+def validate_in_parallel(batches, workers, dictionaries):
+    """
+    Validate batches in the process pool and return results in the same order.
+    Only a few batches are sent to the pool at once,
+    so we don't read the whole db into memory
+    """
+    with ProcessPoolExecutor(workers, initializer=init_validation, initargs=(dictionaries,)) as executor:
+        futures = deque()
+        for batch in batches:
+            futures.append(executor.submit(validate_logs, batch))
+            if len(futures) > workers * 2:
+                yield futures.popleft().result()
+
+        while futures:
+            yield futures.popleft().result()
+
+
+# it is set in each validation process
+log_compressor = None
+
+
+def init_validation(dictionaries):
+    global log_compressor
+    log_compressor = LogCompressor(dictionaries)
+
+
+def validate_logs(batch):
+    """
+    :param batch: list of (log_id, compressed log_content, content_codec)
+    :return: count of checked logs, count of valid logs, ids of wrong logs, the last log id
+    and batch metrics: compressed and decompressed bytes, decompress and parse seconds, error classes
+    """
+    parser = LogParser()
+    valid_logs = 0
+    wrong_log_ids = []
+    batch_metrics = {
+        "compressed_bytes": 0,
+        "decompressed_bytes": 0,
+        "decompress_seconds": 0,
+        "parse_seconds": 0,
+        "errors": {},
+    }
+
+    for log_id, compressed_content, content_codec in batch:
+        error_class = None
+        try:
+            start_time = time.perf_counter()
+            log_content = log_compressor.decompress(content_codec, compressed_content)
+            parse_start_time = time.perf_counter()
+            batch_metrics["decompress_seconds"] += parse_start_time - start_time
+            batch_metrics["compressed_bytes"] += len(compressed_content)
+            batch_metrics["decompressed_bytes"] += len(log_content or b"")
+
+            if not log_content:
+                error_class = "empty_log"
+            else:
+                # the bytes parser doesn't decode the log, but logs with broken utf-8 are not valid,
+                # decoding without keeping the str is cheap and raises UnicodeDecodeError for them
+                log_content.decode("utf-8")
+                parsed_rounds = parser.split_log_bytes_to_game_rounds(log_content)
+                batch_metrics["parse_seconds"] += time.perf_counter() - parse_start_time
+                if not parsed_rounds:
+                    error_class = "no_rounds"
+                else:
+                    valid_logs += 1
+        except Exception as e:
+            error_class = e.__class__.__name__
+
+        if error_class:
+            wrong_log_ids.append(log_id)
+            batch_metrics["errors"][error_class] = batch_metrics["errors"].get(error_class, 0) + 1
+
+    return len(batch), valid_logs, wrong_log_ids, batch[-1][0], batch_metrics
+
+
+def add_batch_metrics(metrics, checked_logs, valid_logs, batch_metrics):
+    metrics.inc("checked_logs", checked_logs)
+    metrics.inc("valid_logs", valid_logs)
+    for name in ["compressed_bytes", "decompressed_bytes", "decompress_seconds", "parse_seconds"]:
+        metrics.inc(name, batch_metrics[name])
+    for error_class, count in batch_metrics["errors"].items():
+        metrics.inc("errors", count, {"error_class": error_class})
+
+    metrics.set("logs_per_second", metrics.counter("checked_logs") / max(metrics.elapsed(), 0.001))
+    compressed_bytes = metrics.counter("compressed_bytes")
+    metrics.set(
+        "compression_ratio",
+        compressed_bytes and metrics.counter("decompressed_bytes") / compressed_bytes or 0,
+    )
+
+
+def add_wrong_logs_to_download_queue(cursor, log_ids):
+    # sqlite has a limit on the count of variables in one query
+    for x in range(0, len(log_ids), 500):
+        part = log_ids[x : x + 500]
+        placeholders = ", ".join(["?"] * len(part))
+        add_logs_to_download_queue(cursor, f"log_id IN ({placeholders})", part)
+
+
 class LogParser:
+    # every tag together with the text before it, the same slices that
+    # split_log_to_game_rounds builds char by char
+    tag_regex = re.compile(rb"[^>]*>")
+    # words from the tags that should be skipped or that change the rounds structure,
+    # all other tags are copied to the rounds with list slices
+    special_words_regex = re.compile(rb"SHUFFLE|TAIKYOKU|mjloggm|GO|INIT|owari")
+    # not useful tags
+    skip_tags_regex = re.compile(rb"SHUFFLE|TAIKYOKU|mjloggm|GO")
+    shuffle_attribute_regex = re.compile(rb'shuffle="[^"]*"')
+
+    def split_log_bytes_to_game_rounds(self, log_content: bytes) -> List[List[bytes]]:
+        """
+        The same rounds structure as split_log_to_game_rounds returns,
+        but it works directly on the decompressed log bytes
+        and looks only at the tags that matter for the splitting
+        """
+        tags = self.tag_regex.findall(log_content)
+        rounds = []
+
+        current_round_tags = []
+        copied_tags = 0
+        position = 0
+        tag_index = 0
+        for match in self.special_words_regex.finditer(log_content):
+            # index of the tag is the count of ">" before the word
+            tag_index += log_content.count(b">", position, match.start())
+            position = match.start()
+
+            # there can be several special words in one tag
+            if tag_index < copied_tags:
+                continue
+
+            # the word is in the text after the last tag
+            if tag_index == len(tags):
+                break
+
+            current_round_tags.extend(tags[copied_tags:tag_index])
+            copied_tags = tag_index + 1
+
+            tag = tags[tag_index]
+            if self.skip_tags_regex.search(tag):
+                continue
+
+            is_init_tag = b"INIT" in tag
+
+            # new hand was started
+            if is_init_tag and current_round_tags:
+                rounds.append(current_round_tags)
+                current_round_tags = []
+
+            # the end of the game
+            if b"owari" in tag:
+                rounds.append(current_round_tags)
+
+            if is_init_tag:
+                # we dont need seed information
+                # it appears in old logs format
+                tag = self.shuffle_attribute_regex.sub(b"", tag)
+
+            current_round_tags.append(tag)
+
+        current_round_tags.extend(tags[copied_tags:])
+
+        return rounds
+
     def split_log_to_game_rounds(self, log_content: str) -> List[List[str]]:
         tag_start = 0
         rounds = []